@@ -2,20 +2,36 @@
 # Admin: crear usuario, editar roles, y gestionar proveedores
 
 import os
-import time
 import streamlit as st
 import pandas as pd
-from supabase import create_client
-from f_auth import require_administrador, current_user, get_client
-from f_read import get_all_users, list_suppliers, list_categories, list_people
+import pyarrow as pa
+import httpx
+from supabase import create_client, ClientOptions
+from f_auth import (
+    require_administrador,
+    current_user,
+    invalidate_user_roles,
+    with_backoff,
+)
+from f_read import (
+    get_all_users,
+    list_registered_users,
+    fetch_user_roles_map,
+    clear_email_cache,
+    list_suppliers,
+    list_categories,
+    list_people,
+    parallel_fetch,
+)
 from f_cud import (
-    assign_role,
-    remove_role,
+    assign_roles_bulk,
+    bulk_update_user_roles,
     add_app_user,
     create_supplier,
     update_user_password,
     create_category,
     create_person,
+    ROLES,
 )
 
 require_administrador()
@@ -28,7 +44,7 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 
 SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 
-ROLES_ES = ["administrador", "solicitante", "aprobador", "pagador", "lector"]
+ROLES_ES = list(ROLES)
 
 
 @st.cache_resource(show_spinner=False)
@@ -37,10 +53,24 @@ def get_admin_client():
         raise RuntimeError(
             "Faltan SUPABASE_URL o SUPABASE_SERVICE_ROLE_KEY en variables de entorno."
         )
-    return create_client(SUPABASE_URL, SERVICE_ROLE_KEY)
-
+    # Pooled keep-alive transport so repeated admin calls reuse one TLS
+    # connection. This client is only used for auth.admin: supabase-py
+    # rewrites base_url on a shared httpx client for postgrest/storage.
+    http = httpx.Client(
+        limits=httpx.Limits(
+            max_keepalive_connections=15,
+            max_connections=30,
+            keepalive_expiry=30.0,
+        ),
+        http2=True,
+        timeout=30.0,
+    )
+    return create_client(
+        SUPABASE_URL,
+        SERVICE_ROLE_KEY,
+        options=ClientOptions(httpx_client=http),
+    )
 
-ADMIN_CLIENT = get_admin_client()
 
 tab_crear, tab_editar, tab_pass, tab_prov, tab_cats, tab_personas = st.tabs([
     "Crear usuario",
@@ -51,51 +81,22 @@ tab_crear, tab_editar, tab_pass, tab_prov, tab_cats, tab_personas = st.tabs([
     "Personas",
 ])
 
-FRAGMENT_KEYS = {
-    "crear": "admin_crear",
-    "editar": "admin_editar",
-    "pass": "admin_pass",
-    "prov": "admin_prov",
-    "cats": "admin_cats",
-    "personas": "admin_personas",
-}
-
-REFRESH_FLAGS_KEY = "admin_refresh_flags"
+USERS_VERSION_KEY = "users_version"
 
-if REFRESH_FLAGS_KEY not in st.session_state:
-    st.session_state[REFRESH_FLAGS_KEY] = {}
+st.session_state.setdefault(USERS_VERSION_KEY, 0)
 
 
-def mark_fragment_refresh(data_key: str, fragments) -> None:
-    """Mark other fragments to refresh cached data when they run next."""
+def bump_users_version() -> None:
+    """Invalidate the cached user list after a user/role/allowlist write.
 
-    flags = st.session_state.setdefault(REFRESH_FLAGS_KEY, {})
-    current = set(flags.get(data_key, []))
-    current.update(fragments or [])
-    flags[data_key] = sorted(current)
-    st.session_state[REFRESH_FLAGS_KEY] = flags
+    The snapshot cache is process-wide, so it is cleared outright: a
+    per-session version alone could collide with another admin's. The
+    version still resets this session's roles editor.
+    """
 
-
-def consume_fragment_refresh(data_key: str, fragment_name: str, clear_fn=None) -> None:
-    """Clear cached data when the current fragment needs to refresh it."""
-
-    flags = st.session_state.get(REFRESH_FLAGS_KEY, {})
-    targets = set(flags.get(data_key, []))
-    if fragment_name not in targets:
-        return
-
-    if clear_fn is not None:
-        try:
-            clear_fn()
-        except Exception:
-            pass
-
-    targets.discard(fragment_name)
-    if targets:
-        flags[data_key] = sorted(targets)
-    else:
-        flags.pop(data_key, None)
-    st.session_state[REFRESH_FLAGS_KEY] = flags
+    get_all_users.clear()
+    clear_email_cache()
+    st.session_state[USERS_VERSION_KEY] = st.session_state.get(USERS_VERSION_KEY, 0) + 1
 
 
 @st.fragment
@@ -105,10 +106,10 @@ def admin_crear_fragment():
         display_name = st.text_input("Nombre para mostrar (opcional)")
 
         st.caption("Asigna uno o varios roles para este usuario:")
-        cols = st.columns(5)
+        cols = st.columns(len(ROLES_ES))
         role_checks = {}
-        for i, role in enumerate(ROLES_ES):
-            with cols[i % 5]:
+        for role, col in zip(ROLES_ES, cols):
+            with col:
                 role_checks[role] = st.checkbox(role, value=(role == "solicitante"))
 
         allow_otp = st.checkbox("Agregar a la lista permitida (OTP)", value=True)
@@ -122,61 +123,54 @@ def admin_crear_fragment():
             return
 
         try:
-            sb_admin = ADMIN_CLIENT
-            sb_admin.auth.admin.create_user(
+            sb_admin = get_admin_client()
+            resp = with_backoff(conflict_ok=True)(sb_admin.auth.admin.create_user)(
                 {
                     "email": email,
                     "email_confirm": True,
                     "user_metadata": {"display_name": display_name} if display_name else {},
                 }
             )
-
-            if allow_otp:
-                try:
-                    add_app_user(email)
-                except Exception as e:
-                    st.warning(
-                        f"Usuario creado, pero no se pudo agregar a OTP allowlist: {e}"
-                    )
-
-            sb = get_client()
-            uid = None
-            for _ in range(3):
-                row = (
-                    sb.schema("public")
-                    .table("users")
-                    .select("id,email")
-                    .ilike("email", email.strip())
-                    .limit(1)
-                    .execute()
-                ).data
-                if row:
-                    uid = row[0]["id"]
-                    break
-                time.sleep(0.5)
+            created = getattr(resp, "user", None)
+            uid = getattr(created, "id", None)
 
             selected_roles = [r for r, v in role_checks.items() if v]
-            if uid and selected_roles:
-                for r in selected_roles:
+            assign_roles = bool(uid and selected_roles)
+
+            def _try(fn, *args):
+                # Devuelve la excepción en vez de lanzarla, para avisar de cada fallo por separado.
+                def run():
                     try:
-                        assign_role(uid, r)
+                        fn(*args)
                     except Exception as e:
-                        st.warning(f"No se pudo asignar rol {r}: {e}")
+                        return e
+                    return None
+                return run
+
+            # Allowlist y roles son escrituras independientes: se envían a la vez.
+            writes = []
+            if allow_otp:
+                writes.append(_try(add_app_user, email))
+            if assign_roles:
+                writes.append(_try(assign_roles_bulk, uid, selected_roles))
+            errors = parallel_fetch(*writes)
+
+            if allow_otp and errors[0]:
+                st.warning(
+                    f"Usuario creado, pero no se pudo agregar a OTP allowlist: {errors[0]}"
+                )
+            if assign_roles:
+                if errors[-1]:
+                    st.warning(f"No se pudieron asignar los roles: {errors[-1]}")
+                else:
+                    invalidate_user_roles(uid)
             elif not uid:
                 st.warning(
-                    "Usuario creado en Auth. Aún no aparece en public.users; "
-                    "refresca esta página en unos segundos para asignar roles."
+                    "Usuario creado en Auth, pero no se recibió su id; "
+                    "asigna los roles desde 'Editar usuario'."
                 )
 
-            try:
-                get_all_users.clear()
-            except Exception:
-                pass
-
-            mark_fragment_refresh(
-                "users",
-                [FRAGMENT_KEYS["editar"], FRAGMENT_KEYS["pass"]],
-            )
+            bump_users_version()
 
             st.success(f"Usuario creado: {email}")
             st.rerun(scope="fragment")
@@ -186,87 +180,75 @@ def admin_crear_fragment():
 
 @st.fragment
 def admin_editar_fragment():
-    consume_fragment_refresh(
-        "users",
-        FRAGMENT_KEYS["editar"],
-        getattr(get_all_users, "clear", None),
-    )
-
-    users = get_all_users()
+    users_version = st.session_state[USERS_VERSION_KEY]
+    users = list_registered_users(users_version)
     if not users:
         st.info("Aún no hay usuarios.")
-        st.stop()
-
-    def _label(u: dict) -> str:
-        nom = (u.get("display_name") or "").strip()
-        return f"{u['email']} — {nom}" if nom else u["email"]
-
-    options = {_label(u): u for u in users}
-    selected_label = st.selectbox("Selecciona un usuario", list(options.keys()))
-    selected_user = options[selected_label] if selected_label else None
-
-    if not selected_user:
         return
 
-    roles_set = set(selected_user.get("roles", []))
     me = current_user()
     my_id = me["id"] if me else None
 
-    st.caption("Marca/Desmarca para asignar o quitar roles:")
-    cols2 = st.columns(5)
-    role_boxes = {}
-    for i, role in enumerate(ROLES_ES):
-        with cols2[i % 5]:
-            role_boxes[role] = st.checkbox(
-                role,
-                value=(role in roles_set),
-                key=f"cb-{role}-{selected_user['id']}",
-            )
-
-    if not st.button("Guardar cambios"):
-        return
-
-    try:
-        desired = {r for r, v in role_boxes.items() if v}
-        current = roles_set
-
-        to_add = desired - current
-        to_remove = current - desired
-
-        if selected_user["id"] == my_id and "administrador" in to_remove:
-            st.warning("No puedes quitarte el rol 'administrador' a ti mismo.")
-            to_remove.discard("administrador")
+    current = fetch_user_roles_map(users_version)
+    original = pd.DataFrame(
+        {
+            "id": [uid for uid, _ in users],
+            "Usuario": [email for _, email in users],
+            **{r: [r in current.get(uid, ()) for uid, _ in users] for r in ROLES_ES},
+        }
+    )
 
-        for r in sorted(to_add):
-            assign_role(selected_user["id"], r)
-            st.success(f"Rol '{r}' asignado.")
+    st.caption("Marca/Desmarca para asignar o quitar roles y guarda una sola vez:")
+    with st.form("editar_roles_form"):
+        edited = st.data_editor(
+            original,
+            column_config={
+                "id": None,
+                "Usuario": st.column_config.TextColumn("Usuario"),
+                **{r: st.column_config.CheckboxColumn(r) for r in ROLES_ES},
+            },
+            disabled=["id", "Usuario"],
+            num_rows="fixed",
+            hide_index=True,
+            use_container_width=True,
+            key=f"roles_editor_{users_version}",
+        )
 
-        for r in sorted(to_remove):
-            remove_role(selected_user["id"], r)
-            st.success(f"Rol '{r}' removido.")
+        submitted = st.form_submit_button("Guardar cambios")
+        if not submitted:
+            return
 
         try:
-            get_all_users.clear()
-        except Exception:
-            pass
-
-        mark_fragment_refresh("users", [FRAGMENT_KEYS["pass"]])
+            desired = {
+                row["id"]: {r for r in ROLES_ES if row[r]}
+                for row in edited.to_dict(orient="records")
+            }
+
+            if (
+                my_id in desired
+                and "administrador" in current.get(my_id, set())
+                and "administrador" not in desired[my_id]
+            ):
+                st.warning("No puedes quitarte el rol 'administrador' a ti mismo.")
+                desired[my_id].add("administrador")
+
+            changed = bulk_update_user_roles(current, desired)
+            if not changed:
+                st.info("No hay cambios que guardar.")
+                return
+
+            st.success(f"Roles actualizados ({changed} usuario(s)).")
+            invalidate_user_roles(*desired.keys())
+            bump_users_version()
 
-        st.rerun(scope="fragment")
-    except Exception as e:
-        st.error(f"Error al guardar cambios: {e}")
+            st.rerun(scope="fragment")
+        except Exception as e:
+            st.error(f"Error al guardar cambios: {e}")
 
 
 @st.fragment
 def admin_pass_fragment():
-    consume_fragment_refresh(
-        "users",
-        FRAGMENT_KEYS["pass"],
-        getattr(get_all_users, "clear", None),
-    )
-
-    users = get_all_users()
-    emails = [u["email"] for u in users]
+    emails = [email for _, email in list_registered_users(st.session_state[USERS_VERSION_KEY])]
     if not emails:
         st.info("Aún no hay usuarios.")
         return
@@ -291,30 +273,21 @@ def admin_pass_fragment():
 
 @st.fragment
 def admin_prov_fragment():
-    consume_fragment_refresh(
-        "suppliers",
-        FRAGMENT_KEYS["prov"],
-        getattr(list_suppliers, "clear", None),
-    )
-    consume_fragment_refresh(
-        "categories",
-        FRAGMENT_KEYS["prov"],
-        getattr(list_categories, "clear", None),
-    )
-
     st.subheader("Proveedores")
 
-    sups = list_suppliers()
+    sups, cats = parallel_fetch(list_suppliers, list_categories)
     if sups:
-        df = pd.DataFrame(
-            [{"Proveedor": s["name"], "Categoría": s.get("category", "")} for s in sups]
+        tbl = pa.table(
+            {
+                "Proveedor": [s["name"] for s in sups],
+                "Categoría": [s.get("category", "") for s in sups],
+            }
         )
-        st.dataframe(df, use_container_width=True, hide_index=True)
+        st.dataframe(tbl, use_container_width=True, hide_index=True)
     else:
         st.caption("Aún no hay proveedores.")
 
     st.markdown("### Agregar proveedor")
-    cats = list_categories()
     if not cats:
         st.info("No hay categorías. Primero agrega categorías en la pestaña 'Categorías'.")
 
@@ -344,18 +317,12 @@ def admin_prov_fragment():
 
 @st.fragment
 def admin_cats_fragment():
-    consume_fragment_refresh(
-        "categories",
-        FRAGMENT_KEYS["cats"],
-        getattr(list_categories, "clear", None),
-    )
-
     st.subheader("Categorías")
 
     cats = list_categories()
     if cats:
         st.dataframe(
-            pd.DataFrame({"Categoría": cats}), use_container_width=True, hide_index=True
+            pa.table({"Categoría": cats}), use_container_width=True, hide_index=True
         )
     else:
         st.caption("Aún no hay categorías.")
@@ -377,7 +344,6 @@ def admin_cats_fragment():
                 list_categories.clear()
             except Exception:
                 pass
-            mark_fragment_refresh("categories", [FRAGMENT_KEYS["prov"]])
             st.success("Categoría agregada.")
             st.rerun(scope="fragment")
         except Exception as e:
@@ -390,18 +356,12 @@ def admin_cats_fragment():
 
 @st.fragment
 def admin_personas_fragment():
-    consume_fragment_refresh(
-        "people",
-        FRAGMENT_KEYS["personas"],
-        getattr(list_people, "clear", None),
-    )
-
     st.subheader("Personas")
 
     personas = list_people()
     if personas:
         st.dataframe(
-            pd.DataFrame({"Nombre": personas}),
+            pa.table({"Nombre": personas}),
             use_container_width=True,
             hide_index=True,
         )
@@ -435,6 +395,15 @@ def admin_personas_fragment():
                 st.error(f"No se pudo agregar: {e}")
 
 
+# Todas las pestañas se renderizan en cada corrida: calentamos en paralelo las
+# cachés que leen, así una carga en frío paga un solo viaje de red.
+parallel_fetch(
+    lambda: get_all_users(st.session_state[USERS_VERSION_KEY]),
+    list_suppliers,
+    list_categories,
+    list_people,
+)
+
 # =======================
 # Tab 1: Crear usuario
 # =======================
@@ -3,10 +3,13 @@
 
 import pandas as pd
 import streamlit as st
+from postgrest.exceptions import APIError
 from f_auth import require_aprobador, current_user
 from f_read import (
-    list_expenses_for_status,          # -> for metrics/table in Tab 1
+    list_expenses_for_status,          # -> for table in Tab 1
+    list_expense_status_counts,        # -> for metrics in Tab 1
     get_expense_by_id_for_approver,    # -> full row for details
+    get_approver_detail_bundle,        # -> row + logs + comments + supplier history
     list_expense_logs,
     list_expense_comments,
     signed_url_for_receipt,
@@ -17,7 +20,13 @@ from f_read import (
     list_expenses_by_supplier_id,
     list_expenses_by_category,
     list_expenses_by_requester,
+    clear_expense_status_caches,
+    clear_expense_comment_caches,
     _render_download,
+    _fmt_dt,
+    _records_df,
+    LOG_COLUMNS,
+    COMMENT_COLUMNS,
 )
 from f_cud import update_expense_status, add_expense_comment
 
@@ -31,63 +40,65 @@ if not me:
     st.stop()
 user_id = me["id"]
 
-ESTADOS = ["solicitado", "aprobado", "rechazado", "pagado"]
+ESTADOS = ("solicitado", "aprobado", "rechazado", "pagado")
+ESTADOS_ACTUALIZABLES = ("solicitado", "aprobado", "rechazado")
+_IDX_ACTUALIZABLES = {s: i for i, s in enumerate(ESTADOS_ACTUALIZABLES)}
+HIST_PAGE_SIZE = 50
 
 st.session_state.setdefault("aprobador_resumen_needs_refresh", False)
 st.session_state.setdefault("aprobador_historial_needs_refresh", False)
+st.session_state.setdefault("aprobador_historial_page", 0)
+st.session_state.setdefault("aprobador_historial_filtro", None)
 
 tab1, tab2, tab3 = st.tabs(["Solicitudes", "Detalles y actualizar", "Historial"])
 
 
+def _label_options(df: pd.DataFrame, rows) -> dict:
+    """Etiqueta de selectbox -> id, armada en bloque desde las columnas ya formateadas."""
+    labels = df["Proveedor"].str.cat(
+        [df["Descripción"], df["Creado"], df["Solicitante"]], sep=" — "
+    )
+    return dict(zip(labels, (r["id"] for r in rows)))
+
+
 @st.fragment
-def aprobador_resumen_fragment():
+def aprobador_resumen_metricas_fragment():
     if st.session_state.get("aprobador_resumen_needs_refresh"):
         st.session_state.aprobador_resumen_needs_refresh = False
         st.rerun(scope="fragment")
 
     st.write("**Solicitudes**")
 
-    all_rows = list_expenses_for_status(status=None)
-
-    counts = {e: 0 for e in ESTADOS}
-    for r in all_rows:
-        if r["status"] in counts:
-            counts[r["status"]] += 1
+    counts = list_expense_status_counts(ESTADOS)
     cols = st.columns(len(ESTADOS))
     for i, e in enumerate(ESTADOS):
         cols[i].metric(e.capitalize(), counts[e])
 
-    st.divider()
 
+@st.fragment
+def aprobador_resumen_tabla_fragment():
+    # Separado de las métricas: cambiar el filtro solo vuelve a ejecutar esta parte.
     selected_status = st.selectbox(
         "Filtrar por estado",
         options=ESTADOS,
         index=0,
     )
-    rows = [r for r in all_rows if r["status"] == selected_status]
+    rows = list_expenses_for_status(status=selected_status)
 
     if not rows:
         st.caption("No hay solicitudes para este filtro.")
         return
 
-    def _fmt_dt(s: str) -> str:
-        try:
-            return pd.to_datetime(s).strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            return s
-
-    df = pd.DataFrame(
-        [
-            {
-                "Solicitante": r.get("requested_by_email", ""),
-                "Monto": f"{r['amount']:.2f}",
-                "Descripción": r.get("description") or "",
-                "Categoría": r["category"],
-                "Proveedor": r["supplier_name"],
-                "Creado": _fmt_dt(r["created_at"]),
-            }
-            for r in rows
-        ]
+    df = _records_df(
+        rows,
+        {
+            "requested_by_email": "Solicitante",
+            "amount": "Monto",
+            "description": "Descripción",
+            "category": "Categoría",
+            "supplier_name": "Proveedor",
+            "created_at": "Creado",
+        },
     )
     st.dataframe(df, use_container_width=True, hide_index=True)
 
@@ -107,17 +118,18 @@ def aprobador_detalle_fragment():
         st.caption("No hay solicitudes en este estado.")
         st.stop()
 
-    def _fmt_dt(s: str) -> str:
-        try:
-            return pd.to_datetime(s).strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            return s
-
-    opts = {
-        f"{r['supplier_name']} — {r.get('description','')} — {_fmt_dt(r['created_at'])} — {r.get('requested_by_email','')}"
-        : r["id"]
-        for r in rows
-    }
+    opts = _label_options(
+        _records_df(
+            rows,
+            {
+                "supplier_name": "Proveedor",
+                "description": "Descripción",
+                "created_at": "Creado",
+                "requested_by_email": "Solicitante",
+            },
+        ),
+        rows,
+    )
     sel_label = st.selectbox(
         "Selecciona una solicitud",
         [""] + list(opts.keys()),
@@ -128,10 +140,15 @@ def aprobador_detalle_fragment():
         st.stop()
     expense_id = opts[sel_label]
 
-    exp = get_expense_by_id_for_approver(expense_id)
-    if not exp:
+    try:
+        bundle = get_approver_detail_bundle(expense_id)
+    except APIError:
+        st.error("No se pudo cargar el detalle de la solicitud. Intenta de nuevo.")
+        st.stop()
+    if not bundle:
         st.error("No se encontró la solicitud seleccionada.")
         st.stop()
+    exp = bundle["expense"]
 
     left, mid, right = st.columns([2, 1, 3])
 
@@ -144,7 +161,7 @@ def aprobador_detalle_fragment():
             f"**Monto:** {exp['amount']:.2f}  \n"
             f"**Categoría:** {exp['category']}  \n"
             f"**Estado actual:** {exp['status']}  \n"
-            f"**Creado:** {_fmt_dt(exp['created_at'])}  \n"
+            f"**Creado:** {_fmt_dt([exp['created_at']])[0]}  \n"
             f"**Solicitante:** {exp.get('requested_by_email','')}  \n"
             f"**Reembolso:** {'Sí' if exp.get('reimbursement') else 'No'}"
         )
@@ -161,56 +178,35 @@ def aprobador_detalle_fragment():
 
         st.divider()
         st.write("**Historial (logs)**")
-        logs = list_expense_logs(expense_id)
+        logs = bundle["logs"]
         if not logs:
             st.caption("Sin historial.")
         else:
-            log_df = pd.DataFrame(
-                [
-                    {
-                        "Fecha": _fmt_dt(lg["created_at"]),
-                        "Actor": lg.get("actor_email", ""),
-                        "Mensaje": lg.get("message", ""),
-                    }
-                    for lg in logs
-                ]
-            )
+            log_df = _records_df(logs, LOG_COLUMNS)
             st.dataframe(log_df, use_container_width=True, hide_index=True)
 
         st.write("**Comentarios**")
-        comments = list_expense_comments(expense_id)
+        comments = bundle["comments"]
         if not comments:
             st.caption("No hay comentarios.")
         else:
-            com_df = pd.DataFrame(
-                [
-                    {
-                        "Fecha": _fmt_dt(c["created_at"]),
-                        "Autor": c.get("actor_email", ""),
-                        "Comentario": c["message"],
-                    }
-                    for c in comments
-                ]
-            )
+            com_df = _records_df(comments, COMMENT_COLUMNS)
             st.dataframe(com_df, use_container_width=True, hide_index=True)
 
     with right:
         st.write("**Historial del proveedor**")
-        sup_id = exp.get("supplier_id")
-        hist_rows = list_expenses_by_supplier_id(sup_id) if sup_id else []
+        hist_rows = bundle["supplier_history"]
         if hist_rows:
-            hist_df = pd.DataFrame(
-                [
-                    {
-                        "Descripción": r.get("description", "") or "",
-                        "Monto": f"{r['amount']:.2f}",
-                        "Categoría": r["category"],
-                        "Estado": r["status"],
-                        "Solicitante": r.get("requested_by_email", ""),
-                        "Creado": _fmt_dt(r["created_at"]),
-                    }
-                    for r in hist_rows
-                ]
+            hist_df = _records_df(
+                hist_rows,
+                {
+                    "description": "Descripción",
+                    "amount": "Monto",
+                    "category": "Categoría",
+                    "status": "Estado",
+                    "requested_by_email": "Solicitante",
+                    "created_at": "Creado",
+                },
             )
             st.dataframe(hist_df, use_container_width=True, hide_index=True)
         else:
@@ -218,15 +214,10 @@ def aprobador_detalle_fragment():
 
     with mid:
         st.write("**Actualizar estado / agregar comentario**")
-        estados_actualizables = ["solicitado", "aprobado", "rechazado"]
         new_status = st.selectbox(
             "Nuevo estado",
-            options=estados_actualizables,
-            index=(
-                estados_actualizables.index(exp["status"])
-                if exp["status"] in estados_actualizables
-                else 0
-            ),
+            options=ESTADOS_ACTUALIZABLES,
+            index=_IDX_ACTUALIZABLES.get(exp["status"], 0),
         )
         comment = st.text_area("Comentario (opcional)", key="aprobador_comment")
 
@@ -234,14 +225,24 @@ def aprobador_detalle_fragment():
             try:
                 if new_status == exp["status"] and comment.strip():
                     add_expense_comment(expense_id, user_id, comment.strip())
+                    clear_expense_comment_caches(expense_id)
                 else:
-                    update_expense_status(expense_id, user_id, new_status, comment or None)
+                    update_expense_status(
+                        expense_id,
+                        user_id,
+                        new_status,
+                        comment or None,
+                        prev_status=exp["status"],
+                    )
+                    clear_expense_status_caches(expense_id, exp["status"], new_status)
                 st.success("Actualización guardada.")
                 st.session_state.aprobador_comment = ""
                 st.session_state.aprobador_resumen_needs_refresh = True
                 st.session_state.aprobador_historial_needs_refresh = True
                 st.rerun(scope="fragment")
             except Exception as e:
+                # Si otro usuario la cambió, la próxima lectura debe traer su estado real.
+                clear_expense_status_caches(expense_id, exp["status"], new_status)
                 st.error(f"No se pudo actualizar: {e}")
 
 
@@ -266,7 +267,8 @@ def aprobador_historial_fragment():
             st.stop()
         sup_map = {s["name"]: s["id"] for s in sups}
         sel_sup_name = st.selectbox("Proveedor", list(sup_map.keys()))
-        rows = list_expenses_by_supplier_id(sup_map[sel_sup_name])
+        filtro = (modo, sup_map[sel_sup_name])
+        fetch = list_expenses_by_supplier_id
 
     elif modo == "Categorías":
         cats = list_categories()
@@ -274,7 +276,8 @@ def aprobador_historial_fragment():
             st.caption("No hay categorías.")
             st.stop()
         sel_cat = st.selectbox("Categoría", cats)
-        rows = list_expenses_by_category(sel_cat)
+        filtro = (modo, sel_cat)
+        fetch = list_expenses_by_category
 
     else:
         reqs = list_requesters_for_approver()
@@ -283,46 +286,56 @@ def aprobador_historial_fragment():
             st.stop()
         req_map = {r["email"]: r["id"] for r in reqs}
         sel_email = st.selectbox("Solicitante", list(req_map.keys()))
-        rows = list_expenses_by_requester(req_map[sel_email])
+        filtro = (modo, req_map[sel_email])
+        fetch = list_expenses_by_requester
+
+    # Un filtro nuevo vuelve a la primera página.
+    if st.session_state.aprobador_historial_filtro != filtro:
+        st.session_state.aprobador_historial_filtro = filtro
+        st.session_state.aprobador_historial_page = 0
+    page = st.session_state.aprobador_historial_page
+
+    # Se pide una fila extra solo para saber si existe una página siguiente.
+    rows = fetch(filtro[1], limit=HIST_PAGE_SIZE + 1, offset=page * HIST_PAGE_SIZE)
+    has_next = len(rows) > HIST_PAGE_SIZE
+    rows = rows[:HIST_PAGE_SIZE]
 
     if not rows:
         st.caption("No hay gastos para este filtro.")
         st.stop()
 
-    def _fmt_dt(s: str) -> str:
-        try:
-            return pd.to_datetime(s).strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            return s
-
-    df = pd.DataFrame(
-        [
-            {
-                "Proveedor": r["supplier_name"],
-                "Descripción": r.get("description", "") or "",
-                "Monto": f"{r['amount']:.2f}",
-                "Categoría": r["category"],
-                "Estado": r["status"],
-                "Solicitante": r.get("requested_by_email", ""),
-                "Creado": _fmt_dt(r["created_at"]),
-            }
-            for r in rows
-        ]
+    df = _records_df(
+        rows,
+        {
+            "supplier_name": "Proveedor",
+            "description": "Descripción",
+            "amount": "Monto",
+            "category": "Categoría",
+            "status": "Estado",
+            "requested_by_email": "Solicitante",
+            "created_at": "Creado",
+        },
     )
-    st.dataframe(df, use_container_width=True, hide_index=True)
+    st.dataframe(df, use_container_width=True, hide_index=True, height=400)
+
+    prev_col, info_col, next_col = st.columns([1, 2, 1])
+    if prev_col.button("← Anterior", disabled=page == 0, key="aprobador_hist_prev"):
+        st.session_state.aprobador_historial_page -= 1
+        st.rerun(scope="fragment")
+    info_col.caption(f"Página {page + 1}")
+    if next_col.button("Siguiente →", disabled=not has_next, key="aprobador_hist_next"):
+        st.session_state.aprobador_historial_page += 1
+        st.rerun(scope="fragment")
 
-    opt_map = {
-        f"{r['supplier_name']} — {r.get('description','')} — {_fmt_dt(r['created_at'])}  {r.get('requested_by_email','')}"
-        : r["id"]
-        for r in rows
-    }
+    opt_map = _label_options(df, rows)
     sel_label = st.selectbox(
         "Selecciona una solicitud para revisar",
         list(opt_map.keys()),
     )
     eid = opt_map[sel_label]
 
-    exp = get_expense_by_id_for_approver(eid)
+    # La fila de la página ya trae todo lo que se muestra abajo.
+    exp = next((r for r in rows if r["id"] == eid), None)
     if not exp:
         return
 
@@ -333,7 +346,7 @@ def aprobador_historial_fragment():
         f"**Categoría:** {exp['category']}  \n"
         f"**Estado:** {exp['status']}  \n"
         f"**Solicitante:** {exp.get('requested_by_email','')}  \n"
-        f"**Creado:** {_fmt_dt(exp['created_at'])}"
+        f"**Creado:** {_fmt_dt([exp['created_at']])[0]}"
     )
     rec_key = exp.get("supporting_doc_key")
     pay_key = exp.get("payment_doc_key")
@@ -346,37 +359,21 @@ def aprobador_historial_fragment():
     st.divider()
     logs = list_expense_logs(eid)
     if logs:
-        log_df = pd.DataFrame(
-            [
-                {
-                    "Fecha": _fmt_dt(l["created_at"]),
-                    "Actor": l.get("actor_email", ""),
-                    "Mensaje": l.get("message", ""),
-                }
-                for l in logs
-            ]
-        )
+        log_df = _records_df(logs, LOG_COLUMNS)
         st.write("**Historial (logs)**")
         st.dataframe(log_df, use_container_width=True, hide_index=True)
 
     comments = list_expense_comments(eid)
     if comments:
-        com_df = pd.DataFrame(
-            [
-                {
-                    "Fecha": _fmt_dt(c["created_at"]),
-                    "Autor": c.get("actor_email", ""),
-                    "Comentario": c["message"],
-                }
-                for c in comments
-            ]
-        )
+        com_df = _records_df(comments, COMMENT_COLUMNS)
         st.write("**Comentarios**")
         st.dataframe(com_df, use_container_width=True, hide_index=True)
 
 
 with tab1:
-    aprobador_resumen_fragment()
+    aprobador_resumen_metricas_fragment()
+    st.divider()
+    aprobador_resumen_tabla_fragment()
 
 with tab2:
     aprobador_detalle_fragment()
@@ -1,7 +1,12 @@
 import streamlit as st
 from supabase import create_client, Client
+import functools
 import os
-from typing import Optional, Dict, Any, Set
+import random
+import threading
+import time
+import httpx
+from typing import Optional, Dict, Any, FrozenSet, Callable
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "")
@@ -16,12 +21,159 @@ def get_client() -> Client:
     return create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
 
 
-# ---------- Login / Session ----------
+# ---------- Retries ----------
+
+BREAKER_FAIL_MAX = 5
+BREAKER_RESET_TIMEOUT = 30.0
+
+_breaker_lock = threading.Lock()
+_breaker = {"failures": 0, "opened_at": 0.0, "probing": False}
+
+
+# PostgREST reports 503/504 through its own codes (the HTTP status is not
+# kept on APIError); plus the SQLSTATEs that mean "try again".
+_RETRYABLE_CODES = frozenset({
+    "PGRST000", "PGRST001", "PGRST002", "PGRST003",  # db unreachable / schema cache / pool timeout
+    "40001", "40P01",                                # serialization failure, deadlock
+    "53300", "57P01", "57P03",                       # too many connections, shutdown, starting up
+})
+
+
+def _error_code(exc: Exception) -> Optional[str]:
+    """PostgREST/SQLSTATE code of an error, from the attribute or its JSON body."""
+    code = getattr(exc, "code", None)
+    if code is None and callable(getattr(exc, "json", None)):
+        try:
+            code = (exc.json() or {}).get("code")
+        except Exception:
+            code = None
+    return code if isinstance(code, str) else None
+
+
+def _error_status(exc: Exception) -> Optional[int]:
+    """Best-effort HTTP status of a Supabase/PostgREST/Auth error."""
+    response = getattr(exc, "response", None)
+    if isinstance(getattr(response, "status_code", None), int):
+        return response.status_code
+    for attr in ("status", "status_code", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str) and len(value) == 3 and value.isdigit():
+            return int(value)
+    return None
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, httpx.TransportError):
+        return True
+    code = _error_code(exc)
+    if code and (code in _RETRYABLE_CODES or code.startswith("08")):  # 08xxx: connection exception
+        return True
+    status = _error_status(exc)
+    return status is not None and (status == 429 or 500 <= status < 600)
+
+
+def _is_conflict(exc: Exception) -> bool:
+    """True for unique violations (PostgREST) or an already existing Auth user."""
+    code = getattr(exc, "code", None)
+    return code in ("23505", "email_exists", "user_already_exists")
+
+
+def _breaker_check() -> None:
+    with _breaker_lock:
+        if _breaker["failures"] < BREAKER_FAIL_MAX:
+            return
+        if (
+            not _breaker["probing"]
+            and time.monotonic() - _breaker["opened_at"] >= BREAKER_RESET_TIMEOUT
+        ):
+            # half-open: exactly one trial call goes through; the rest keep
+            # failing fast until _breaker_record settles it.
+            _breaker["probing"] = True
+            return
+    raise RuntimeError(
+        "El servicio no está disponible en este momento. Intenta de nuevo en unos segundos."
+    )
+
+
+def _breaker_release() -> None:
+    """Free the half-open slot without judging the backend (call was interrupted)."""
+    with _breaker_lock:
+        _breaker["probing"] = False
 
-def _roles_cache() -> Dict[str, Set[str]]:
-    """Return the cache dict stored in session_state."""
-    return st.session_state.setdefault("roles_cache", {})
 
+def _breaker_record(ok: bool) -> None:
+    with _breaker_lock:
+        _breaker["probing"] = False
+        if ok:
+            _breaker["failures"] = 0
+            return
+        _breaker["failures"] += 1
+        if _breaker["failures"] >= BREAKER_FAIL_MAX:
+            _breaker["opened_at"] = time.monotonic()
+
+
+def with_backoff(
+    max_retries: int = 3,
+    base: float = 0.25,
+    cap: float = 2.0,
+    jitter: float = 0.5,
+    conflict_ok: bool = False,
+) -> Callable:
+    """Retry a Supabase call on 429/5xx or network errors with exponential backoff.
+
+    All decorated calls share one circuit breaker: after ``BREAKER_FAIL_MAX``
+    consecutive transient failures, calls fail fast for
+    ``BREAKER_RESET_TIMEOUT`` seconds instead of piling up more retries.
+    After that a single trial call is let through; the others keep failing
+    fast until it succeeds (closing the breaker) or fails (re-opening it).
+    Non-transient errors (validation, unique violations, ...) are raised at once.
+
+    The defaults keep the worst case around 2-3 s: these calls run inside
+    the synchronous Streamlit script, behind a button the user is waiting on.
+
+    With ``conflict_ok`` a create becomes idempotent across retries: if a
+    retried attempt hits a unique violation, the earlier attempt did land
+    (only its response was lost), so the call returns ``None`` instead of
+    raising. A conflict on the first attempt is still raised to the caller.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            attempt = 0
+            while True:
+                _breaker_check()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as exc:
+                    if attempt > 0 and conflict_ok and _is_conflict(exc):
+                        _breaker_record(True)
+                        return None
+                    if not _is_retryable(exc):
+                        # The backend answered, so it is up; this also settles a probe.
+                        _breaker_record(True)
+                        raise
+                    _breaker_record(False)
+                    if attempt >= max_retries:
+                        raise
+                    delay = min(cap, base * (2 ** attempt))
+                    time.sleep(delay + random.uniform(0, jitter * delay))
+                    attempt += 1
+                    continue
+                except BaseException:
+                    _breaker_release()
+                    raise
+                _breaker_record(True)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+# ---------- Login / Session ----------
 
 def login(email: str, password: str) -> Optional[Dict[str, Any]]:
     """Validate email/password against users table. Returns user row or None."""
@@ -50,31 +202,39 @@ def current_user() -> Optional[Dict[str, Any]]:
 
 # --- Role helpers (Spanish) ---
 
-def user_roles(user_id: str, *, force_refresh: bool = False) -> Set[str]:
-    if not user_id:
-        return set()
-
-    cache = _roles_cache()
-    if not force_refresh and user_id in cache:
-        return cache[user_id]
-
+@st.cache_data(ttl=300, max_entries=1000, show_spinner=False)
+def _fetch_user_roles(user_id: str) -> FrozenSet[str]:
     sb = get_client()
     res = (
-        sb.schema("public")
-        .table("user_roles")
+        sb.table("user_roles")
         .select("role")
         .eq("user_id", user_id)
         .execute()
     )
-    roles = {row["role"] for row in (res.data or [])}
-    cache[user_id] = roles
-    return roles
+    return frozenset(row["role"] for row in (res.data or []))
+
+
+def invalidate_user_roles(*user_ids: str) -> None:
+    """Drop cached roles for the given users (all users if none given)."""
+    if not user_ids:
+        _fetch_user_roles.clear()
+        return
+    for uid in user_ids:
+        _fetch_user_roles.clear(uid)
+
+
+def user_roles(user_id: str, *, force_refresh: bool = False) -> FrozenSet[str]:
+    if not user_id:
+        return frozenset()
+    if force_refresh:
+        invalidate_user_roles(user_id)
+    return _fetch_user_roles(user_id)
 
 
-def current_user_roles(*, force_refresh: bool = False) -> Set[str]:
+def current_user_roles(*, force_refresh: bool = False) -> FrozenSet[str]:
     user = current_user()
     if not user:
-        return set()
+        return frozenset()
     return user_roles(user["id"], force_refresh=force_refresh)
 
 
@@ -127,5 +287,6 @@ def require_lector():
 
 def sign_out():
     """Clear stored user info and role cache."""
-    for k in ("user", "roles_cache"):
-        st.session_state.pop(k, None)
+    user = st.session_state.pop("user", None)
+    if user:
+        invalidate_user_roles(user["id"])
@@ -1,52 +1,83 @@
 # f_cud.py
 # Create/Update/Delete actions for Admin (allowlist, roles, suppliers)
+import functools
+import re
 import streamlit as st
-from typing import List, Optional
-from f_auth import get_client
-from f_read import get_user_id_by_email
+from typing import Dict, List, Optional, Set
+from f_auth import get_client, with_backoff
+from f_read import get_user_id_by_email, parallel_fetch
+
+@functools.lru_cache(maxsize=1024)
+def _norm(s: Optional[str]) -> str:
+    """Normaliza correos y roles (``strip`` + ``lower``); los valores repetidos salen del caché."""
+    s = (s or "").strip()
+    return s if s.islower() else s.lower()
+
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 
 # ------------- Allowlist (app_users) -------------
 
+@with_backoff()
 def add_app_user(email: str) -> None:
     sb = get_client()
-    email_norm = (email or "").strip().lower()
-    if not email_norm:
+    email_norm = _norm(email)
+    if not _EMAIL_RE.match(email_norm):
         raise ValueError("Correo inválido.")
-    sb.schema("public").table("app_users").upsert({"email": email_norm}).execute()
+    sb.table("app_users").upsert({"email": email_norm}, returning="minimal").execute()
 
 def delete_app_user(email: str) -> None:
     sb = get_client()
-    email_norm = (email or "").strip().lower()
-    sb.schema("public").table("app_users").delete().eq("email", email_norm).execute()
+    email_norm = _norm(email)
+    sb.table("app_users").delete(returning="minimal").eq("email", email_norm).execute()
 
 # ------------- Passwords -------------
 
+@with_backoff()
 def update_user_password(email: str, new_password: str) -> None:
     sb = get_client()
     email_norm = (email or "").strip()
     if not email_norm:
         raise ValueError("Correo inválido.")
-    sb.schema("public").table("users").update({"password": new_password}).eq("email", email_norm).execute()
+    sb.table("users").update({"password": new_password}, returning="minimal").eq("email", email_norm).execute()
 
 # ------------- Roles (user_roles) -------------
 
-VALID_ROLES = {"administrador", "solicitante", "aprobador", "pagador", "lector"}
+# Single source of truth for role names (display order); pages import it from here.
+ROLES = ("administrador", "solicitante", "aprobador", "pagador", "lector")
+VALID_ROLES = frozenset(ROLES)
 
+@with_backoff()
 def set_user_roles(user_id: str, roles: List[str]) -> None:
     """
-    Replace all roles for a user with the given set (atomic).
+    Replace all roles for a user with the given set.
     Requires the user already exists in public.users (i.e., has logged in at least once).
+
+    Upserts the wanted roles first and then deletes the rest, so roles kept
+    across the change never disappear, not even briefly.
     """
     if not user_id:
         raise ValueError("Usuario inválido.")
-    roles_clean = [r for r in roles if r in VALID_ROLES]
+    roles_clean = sorted({r for r in roles if r in VALID_ROLES})
     sb = get_client()
-    # Remove current roles
-    sb.schema("public").table("user_roles").delete().eq("user_id", user_id).execute()
-    # Insert new ones (if any)
-    if roles_clean:
-        rows = [{"user_id": user_id, "role": r} for r in roles_clean]
-        sb.schema("public").table("user_roles").insert(rows).execute()
+    if not roles_clean:
+        sb.table("user_roles").delete(returning="minimal").eq("user_id", user_id).execute()
+        return
+    rows = [{"user_id": user_id, "role": r} for r in roles_clean]
+    # ignore_duplicates -> ON CONFLICT DO NOTHING: roles the user already has are not rewritten.
+    (
+        sb.table("user_roles")
+        .upsert(
+            rows, on_conflict="user_id,role", ignore_duplicates=True, returning="minimal"
+        )
+        .execute()
+    )
+    (
+        sb.table("user_roles")
+        .delete(returning="minimal")
+        .eq("user_id", user_id)
+        .not_.in_("role", roles_clean)
+        .execute()
+    )
 
 def set_user_roles_by_email(email: str, roles: List[str]) -> None:
     """
@@ -59,6 +90,7 @@ def set_user_roles_by_email(email: str, roles: List[str]) -> None:
 
 # ------------- Suppliers -------------
 
+@with_backoff(conflict_ok=True)
 def create_supplier(name: str, category: str) -> None:
     nm = (name or "").strip()
     cat = (category or "").strip()
@@ -66,8 +98,7 @@ def create_supplier(name: str, category: str) -> None:
         raise ValueError("Nombre y categoría son obligatorios.")
     sb = get_client()
     chk = (
-        sb.schema("public")
-        .table("categories")
+        sb.table("categories")
         .select("name")
         .eq("name", cat)
         .single()
@@ -77,26 +108,29 @@ def create_supplier(name: str, category: str) -> None:
         raise ValueError(
             "La categoría no existe. Agrega la categoría primero en Admin > Categorías."
         )
-    sb.schema("public").table("suppliers").insert({"name": nm, "category": cat}).execute()
+    sb.table("suppliers").insert({"name": nm, "category": cat}, returning="minimal").execute()
 
 
+@with_backoff(conflict_ok=True)
 def create_category(name: str) -> None:
     nm = (name or "").strip()
     if not nm:
         raise ValueError("Nombre de categoría inválido.")
     sb = get_client()
-    sb.schema("public").table("categories").insert({"name": nm}).execute()
+    sb.table("categories").insert({"name": nm}, returning="minimal").execute()
 
 
 # ------------- Personas -------------
 
+@with_backoff(conflict_ok=True)
 def create_person(name: str) -> None:
     nm = (name or "").strip()
     if not nm:
         raise ValueError("El nombre es obligatorio.")
     sb = get_client()
-    sb.schema("public").table("people").insert({"name": nm}).execute()
+    sb.table("people").insert({"name": nm}, returning="minimal").execute()
 
+@with_backoff()
 def assign_role(user_id: str, role: str) -> None:
     """
     Grant a single role (Spanish enum string) to the user.
@@ -104,36 +138,106 @@ def assign_role(user_id: str, role: str) -> None:
     """
     if not user_id:
         raise ValueError("Usuario inválido.")
-    role_es = (role or "").strip().lower()
+    role_es = _norm(role)
     if role_es not in VALID_ROLES:
         raise ValueError(f"Rol inválido: {role_es}")
     sb = get_client()
     (
-        sb.schema("public")
-        .table("user_roles")
-        .upsert({"user_id": user_id, "role": role_es})
+        sb.table("user_roles")
+        .upsert(
+            {"user_id": user_id, "role": role_es},
+            on_conflict="user_id,role",
+            ignore_duplicates=True,
+            returning="minimal",
+        )
         .execute()
     )
 
+@with_backoff()
 def remove_role(user_id: str, role: str) -> None:
     """
     Remove a single role from the user. No-op if not present.
     """
     if not user_id:
         raise ValueError("Usuario inválido.")
-    role_es = (role or "").strip().lower()
+    role_es = _norm(role)
     if role_es not in VALID_ROLES:
         raise ValueError(f"Rol inválido: {role_es}")
     sb = get_client()
     (
-        sb.schema("public")
-        .table("user_roles")
-        .delete()
+        sb.table("user_roles")
+        .delete(returning="minimal")
         .eq("user_id", user_id)
         .eq("role", role_es)
         .execute()
     )
 
+@with_backoff()
+def assign_roles_bulk(user_id: str, roles: List[str]) -> None:
+    """
+    Grant several roles to the user in a single upsert.
+    Idempotent: roles already assigned are left untouched.
+    """
+    if not user_id:
+        raise ValueError("Usuario inválido.")
+    roles_es = sorted({_norm(r) for r in roles})
+    invalid = [r for r in roles_es if r not in VALID_ROLES]
+    if invalid:
+        raise ValueError(f"Rol inválido: {', '.join(invalid)}")
+    if not roles_es:
+        return
+    sb = get_client()
+    (
+        sb.table("user_roles")
+        .upsert(
+            [{"user_id": user_id, "role": r} for r in roles_es],
+            on_conflict="user_id,role",
+            ignore_duplicates=True,
+            returning="minimal",
+        )
+        .execute()
+    )
+
+@with_backoff()
+def bulk_update_user_roles(
+    current: Dict[str, Set[str]], desired: Dict[str, Set[str]]
+) -> int:
+    """
+    Apply role changes for many users at once: one upsert with every added
+    (user_id, role) pair and one delete whose ``or`` filter covers every
+    removed pair. Users missing from ``desired`` are left untouched.
+    Returns how many users changed.
+    """
+    to_add: List[Dict[str, str]] = []
+    to_remove: List[str] = []
+    changed = 0
+    for uid, roles in desired.items():
+        want = frozenset(r for r in roles if r in VALID_ROLES)
+        # Solo se comparan roles conocidos: los que el editor no muestra no se tocan.
+        have = frozenset(current.get(uid, ())) & VALID_ROLES
+        added, removed = sorted(want - have), sorted(have - want)
+        if added or removed:
+            changed += 1
+        to_add.extend({"user_id": uid, "role": r} for r in added)
+        if removed:
+            to_remove.append(f"and(user_id.eq.{uid},role.in.({','.join(removed)}))")
+
+    sb = get_client()
+    if to_add:
+        (
+            sb.table("user_roles")
+            .upsert(to_add, on_conflict="user_id,role", returning="minimal")
+            .execute()
+        )
+    if to_remove:
+        (
+            sb.table("user_roles")
+            .delete(returning="minimal")
+            .or_(",".join(to_remove))
+            .execute()
+        )
+    return changed
+
 def create_expense_log(expense_id: str, actor_id: str, message: str) -> None:
     """Inserta un registro en ``expense_logs`` con un ``message`` obligatorio."""
     if not (expense_id and actor_id and (message or "").strip()):
@@ -144,7 +248,33 @@ def create_expense_log(expense_id: str, actor_id: str, message: str) -> None:
         "actor_id": actor_id,
         "message": message.strip(),
     }
-    sb.schema("public").table("expense_logs").insert(payload).execute()
+    sb.table("expense_logs").insert(payload, returning="minimal").execute()
+
+
+def _log_and_comment(
+    expense_id: str,
+    actor_id: str,
+    message: str,
+    comment: Optional[str] = None,
+    *,
+    quiet_log: bool = False,
+) -> None:
+    """Escribe el log de un cambio y, si hay, su comentario en paralelo.
+
+    Son inserts independientes, así que se pagan un solo viaje de red.
+    Con ``quiet_log`` un fallo del log se ignora (el comentario no).
+    """
+    def _log():
+        try:
+            create_expense_log(expense_id, actor_id, message=message)
+        except Exception:
+            if not quiet_log:
+                raise
+
+    calls = [_log]
+    if comment and comment.strip():
+        calls.append(lambda: add_expense_comment(expense_id, actor_id, comment.strip()))
+    parallel_fetch(*calls)
 
 
 def create_expense(
@@ -156,12 +286,13 @@ def create_expense(
     description: Optional[str] = None,   # <--- NEW
     reimbursement: bool = False,
     reimbursement_person: Optional[str] = None,
+    comment: Optional[str] = None,
 ) -> Optional[str]:
     """
     Crea un expense (status 'solicitado') con descripción opcional.
     ``supporting_doc_key`` debe ser el nombre de archivo UUID ubicado en la
     raíz del bucket de Storage (p.ej. ``"uuid.pdf"``); ya no incluye una ruta
-    de carpeta.
+    de carpeta. Si ``comment`` se provee, se guarda como comentario inicial.
     """
     if reimbursement and not (reimbursement_person or "").strip():
         raise ValueError("Debes seleccionar la persona del reembolso.")
@@ -179,24 +310,17 @@ def create_expense(
     if description:
         payload["description"] = description
 
-    res = (
-        sb.schema("public")
-        .table("expenses")
-        .insert(payload, returning="representation")
-        .execute()
-    )
+    query = sb.table("expenses").insert(payload, returning="representation")
+    # Only the id is read back; ?select=id keeps PostgREST from echoing the whole row.
+    query.params = query.params.add("select", "id")
+    res = query.execute()
     data = res.data or []
     expense_id = data[0]["id"] if data else None
 
     if expense_id:
-        try:
-            create_expense_log(
-                expense_id=expense_id,
-                actor_id=requested_by,
-                message="Solicitud creada",
-            )
-        except Exception:
-            pass
+        _log_and_comment(
+            expense_id, requested_by, "Solicitud creada", comment, quiet_log=True
+        )
 
     return expense_id
 
@@ -210,7 +334,7 @@ def add_expense_comment(expense_id: str, created_by: str, message: str) -> None:
         "created_by": created_by,
         "message": message.strip(),
     }
-    sb.schema("public").table("expense_comments").insert(payload).execute()
+    sb.table("expense_comments").insert(payload, returning="minimal").execute()
 
 
 ## APROBADOR
@@ -218,40 +342,57 @@ def add_expense_comment(expense_id: str, created_by: str, message: str) -> None:
 
 VALID_FOR_APPROVER = {"solicitado", "aprobado", "rechazado"}  # 'pagado' is for Pagador
 
-def update_expense_status(expense_id: str, actor_id: str, new_status: str, comment: Optional[str] = None) -> None:
+def update_expense_status(
+    expense_id: str,
+    actor_id: str,
+    new_status: str,
+    comment: Optional[str] = None,
+    prev_status: Optional[str] = None,
+) -> None:
     """
     Cambia estado y agrega un log simple. Si ``comment`` se provee, se guarda como
-    comentario aparte.
+    comentario aparte. ``prev_status`` (el estado que el llamador ya tiene en
+    pantalla) evita consultar el estado anterior antes del update y se usa
+    como versión: si el estado ya cambió, se lanza ``RuntimeError``.
     """
-    ns = (new_status or "").strip().lower()
+    ns = _norm(new_status)
     if ns not in VALID_FOR_APPROVER:
         raise ValueError("Estado inválido para aprobador.")
 
     sb = get_client()
-    # obtener estado anterior para el mensaje del log
-    res = (
-        sb.schema("public")
-        .table("expenses")
-        .select("status")
-        .eq("id", expense_id)
-        .limit(1)
-        .execute()
-    )
-    prev_status = (res.data or [{}])[0].get("status")
+    if prev_status is None:
+        # obtener estado anterior para el mensaje del log
+        res = (
+            sb.table("expenses")
+            .select("status")
+            .eq("id", expense_id)
+            .limit(1)
+            .execute()
+        )
+        prev_status = (res.data or [{}])[0].get("status")
 
     update = {"status": ns}
     if ns in ("aprobado", "rechazado"):
         update["approved_by"] = actor_id
 
-    sb.schema("public").table("expenses").update(update).eq("id", expense_id).execute()
+    # Optimistic concurrency: only update if the status is still the one the
+    # caller saw, so two approvers can't silently overwrite each other.
+    q = sb.table("expenses").update(update).eq("id", expense_id)
+    if prev_status is not None:
+        q = q.eq("status", prev_status)
+    # Only the id is read back; ?select=id keeps PostgREST from echoing the whole row.
+    q.params = q.params.add("select", "id")
+    res = q.execute()
+    if not res.data:
+        if prev_status is None:
+            raise RuntimeError("No se encontró la solicitud.")
+        raise RuntimeError(
+            "La solicitud fue modificada por otra persona. Recarga y vuelve a intentarlo."
+        )
 
-    create_expense_log(
-        expense_id,
-        actor_id,
-        message=f"Solicitud actualizada de {prev_status} a {ns}",
+    _log_and_comment(
+        expense_id, actor_id, f"Solicitud actualizada de {prev_status} a {ns}", comment
     )
-    if comment and comment.strip():
-        add_expense_comment(expense_id, actor_id, comment.strip())
 
 def mark_expense_as_paid(
     expense_id: str,
@@ -279,9 +420,12 @@ def mark_expense_as_paid(
     if payment_doc_key and payment_doc_key.strip():
         update_payload["payment_doc_key"] = payment_doc_key.strip()
 
-    sb.schema("public").table("expenses").update(update_payload).eq("id", expense_id).execute()
+    (
+        sb.table("expenses")
+        .update(update_payload, returning="minimal")
+        .eq("id", expense_id)
+        .execute()
+    )
 
-    create_expense_log(expense_id, actor_id, message="Solicitud pagada")
-    if comment and comment.strip():
-        add_expense_comment(expense_id, actor_id, comment.strip())
+    _log_and_comment(expense_id, actor_id, "Solicitud pagada", comment)
 
@@ -1,9 +1,14 @@
+import functools
+import threading
+from operator import itemgetter
 import streamlit as st
 from typing import List, Dict, Any, Optional, Tuple, Set, Iterable, Callable
 from f_auth import get_client
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import datetime as dt
 import pandas as pd
+from cachetools import TTLCache
 from postgrest.exceptions import APIError
 
 # --------------------------
@@ -25,6 +30,106 @@ def _render_download(
         disabled=not bool(url),
     )
 
+
+def _fmt_dt(values) -> pd.Series:
+    """Formatea fechas ISO en bloque; las que no se pueden leer quedan tal cual."""
+    raw = pd.Series(values, dtype=object)
+    parsed = pd.to_datetime(raw, errors="coerce", utc=True, format="ISO8601")
+    return parsed.dt.strftime("%Y-%m-%d %H:%M").fillna(raw)
+
+
+def _records_df(rows, columns: dict) -> pd.DataFrame:
+    """Tabla a partir de ``rows`` con ``columns`` (campo -> encabezado), formateada por columna."""
+    df = pd.DataFrame.from_records(rows, columns=list(columns))
+    if "amount" in df:
+        df["amount"] = df["amount"].map("{:.2f}".format)
+    if "created_at" in df:
+        df["created_at"] = _fmt_dt(df["created_at"])
+    return df.rename(columns=columns).fillna("")
+
+
+LOG_COLUMNS = {"created_at": "Fecha", "actor_email": "Actor", "message": "Mensaje"}
+COMMENT_COLUMNS = {"created_at": "Fecha", "actor_email": "Autor", "message": "Comentario"}
+
+# --------------------------
+# Utilidades de consulta
+# --------------------------
+PAGE_SIZE = 1000
+
+
+def _fetch_all(
+    build_query: Callable[[], Any], page_size: int = PAGE_SIZE
+) -> List[Dict[str, Any]]:
+    """Trae todas las filas de una consulta paginando con ``.range``.
+
+    PostgREST corta cada respuesta en ``max-rows`` (1000 por defecto en
+    Supabase). ``build_query`` debe devolver un builder nuevo y con orden
+    estable en cada llamada, porque ``.range`` se acumula sobre el builder.
+    """
+    rows: List[Dict[str, Any]] = []
+    start = 0
+    while True:
+        page = build_query().range(start, start + page_size - 1).execute().data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        start += page_size
+
+
+
+def parallel_fetch(*fns: Callable[[], Any]) -> List[Any]:
+    """Ejecuta lecturas independientes en paralelo y devuelve sus resultados en orden.
+
+    Cada lectura es una petición HTTP bloqueante, así que los hilos ocultan la
+    latencia de red. Los hilos reciben el ``ScriptRunContext`` de la sesión
+    para que ``st.cache_data`` funcione igual que en el hilo principal.
+    """
+    if len(fns) <= 1:
+        return [fn() for fn in fns]
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=len(fns),
+        initializer=add_script_run_ctx,
+        initargs=(None, ctx),
+    ) as ex:
+        futures = [ex.submit(fn) for fn in fns]
+        return [f.result() for f in futures]
+
+
+# user_id -> email compartido por todo el proceso. Acotado y con vencimiento:
+# un correo cambiado o un usuario borrado deja de servirse a los 10 minutos,
+# o antes vía ``clear_email_cache``.
+_EMAIL_CACHE: "TTLCache[str, Optional[str]]" = TTLCache(maxsize=5000, ttl=600)
+_EMAIL_CACHE_LOCK = threading.Lock()
+_MISSING = object()
+_ID_EMAIL = itemgetter("id", "email")
+
+
+def _emails_by_ids(ids: Iterable[str]) -> dict:
+    """Mapa ``user_id -> email`` para los ids dados.
+
+    Solo consulta ``users`` por los ids que aún no están en ``_EMAIL_CACHE``.
+    """
+    ids = {i for i in ids if i}
+    if not ids:
+        return {}
+    with _EMAIL_CACHE_LOCK:
+        missing = [i for i in ids if i not in _EMAIL_CACHE]
+    if missing:
+        sb = get_client()
+        res = sb.table("users").select("id,email").in_("id", missing).execute()
+        with _EMAIL_CACHE_LOCK:
+            _EMAIL_CACHE.update(map(_ID_EMAIL, res.data or []))
+    with _EMAIL_CACHE_LOCK:
+        found = {i: _EMAIL_CACHE.get(i, _MISSING) for i in ids}
+    return {i: e for i, e in found.items() if e is not _MISSING}
+
+
+def clear_email_cache() -> None:
+    """Vacía el caché ``user_id -> email`` tras cambios en usuarios."""
+    with _EMAIL_CACHE_LOCK:
+        _EMAIL_CACHE.clear()
+
 # ==========================
 # ==== AUTH AND ADMIN ======
 # ==========================
@@ -56,68 +161,68 @@ def is_registered_email(email: str) -> bool:
         return bool(roles.data)
     return False
 
-@st.cache_data(ttl=30, show_spinner=False)
-def list_registered_users() -> List[Tuple[str, str]]:
+def list_registered_users(version: int = 0) -> List[Tuple[str, str]]:
     """
     Returns list of (user_id, email) for users who have logged in (public.users).
+    Served from the cached ``get_all_users`` snapshot.
     """
-    sb = get_client()
-    res = sb.schema("public").table("users").select("id,email").order("email").execute()
-    rows = res.data or []
-    return [(r["id"], r.get("email") or "") for r in rows]
+    return [(u["id"], u["email"]) for u in get_all_users(version)]
 
-@st.cache_data(ttl=30, show_spinner=False)
-def fetch_user_roles_map() -> Dict[str, Set[str]]:
+def fetch_user_roles_map(version: int = 0) -> Dict[str, Set[str]]:
     """
     Returns a mapping user_id -> set(roles) from public.user_roles.
+    Served from the cached ``get_all_users`` snapshot.
     """
-    sb = get_client()
-    res = sb.schema("public").table("user_roles").select("user_id,role").execute()
-    out: Dict[str, Set[str]] = {}
-    for r in (res.data or []):
-        out.setdefault(r["user_id"], set()).add(r["role"])
-    return out
+    return {u["id"]: set(u["roles"]) for u in get_all_users(version) if u["roles"]}
 
-@st.cache_data(ttl=30, show_spinner=False)
+# Tablas de referencia (usuarios, proveedores, categorías, personas) se
+# guardan con ``st.cache_resource``: todas las sesiones comparten el mismo
+# objeto sin copiarlo en cada lectura. Los llamadores NO deben mutar lo que
+# devuelven; si necesitan modificarlo, que hagan una copia.
+
+@st.cache_resource(ttl=300, show_spinner=False)
 def list_app_users() -> List[str]:
     """Emails allowed to request OTP (from public.app_users)."""
     sb = get_client()
-    res = sb.schema("public").table("app_users").select("email").order("email").execute()
+    res = sb.table("app_users").select("email").order("email").execute()
     return [row["email"] for row in (res.data or [])]
 
-@st.cache_data(ttl=30, show_spinner=False)
+# Curado por el admin, que limpia la caché al crear: el TTL solo cubre
+# cambios hechos fuera de la app.
+@st.cache_resource(ttl=24 * 3600, show_spinner=False)
 def list_suppliers() -> List[Dict[str, Any]]:
     """Return suppliers as [{'id','name','category'}, ...]."""
     sb = get_client()
-    res = (
-        sb.schema("public")
-        .table("suppliers")
+    return _fetch_all(
+        lambda: sb.table("suppliers")
         .select("id,name,category")
         .order("name")
-        .execute()
+        .order("id")
     )
-    return res.data or []
 
 
-@st.cache_data(ttl=60, show_spinner=False)
+# Curado por el admin, que limpia la caché al crear: el TTL solo cubre
+# cambios hechos fuera de la app.
+@st.cache_resource(ttl=24 * 3600, show_spinner=False)
 def list_categories() -> List[str]:
     sb = get_client()
-    res = sb.schema("public").table("categories").select("name").order("name").execute()
+    res = sb.table("categories").select("name").order("name").execute()
     return [r["name"] for r in (res.data or [])]
 
 
-@st.cache_data(ttl=60, show_spinner=False)
+# Curado por el admin, que limpia la caché al crear: el TTL solo cubre
+# cambios hechos fuera de la app.
+@st.cache_resource(ttl=24 * 3600, show_spinner=False)
 def list_people() -> List[str]:
     sb = get_client()
-    res = sb.schema("public").table("people").select("name").order("name").execute()
+    res = sb.table("people").select("name").order("name").execute()
     return [r["name"] for r in (res.data or [])]
 
 def get_user_id_by_email(email: str) -> Optional[str]:
     """Get public.users.id by email (case-insensitive)."""
     sb = get_client()
     q = (
-        sb.schema("public")
-        .table("users")
+        sb.table("users")
         .select("id")
         .ilike("email", (email or "").strip())
         .limit(1)
@@ -127,67 +232,51 @@ def get_user_id_by_email(email: str) -> Optional[str]:
         return q.data[0]["id"]
     return None
 
-@st.cache_data(ttl=30, show_spinner=False)
-def get_all_users() -> List[Dict[str, Any]]:
+@st.cache_resource(ttl=30, show_spinner=False)
+def get_all_users(version: int = 0) -> List[Dict[str, Any]]:
     """
     Return users with their roles for the Admin UI.
+    ``version`` only takes part in the cache key: bump it after a mutation
+    so every caller gets a fresh list without clearing the whole cache.
     Structure per user:
       {
         "id": str,
         "email": str,
         "display_name": str | None,   # reserved; we keep None unless you sync metadata
         "roles": [str, ...],          # e.g., ["administrador","aprobador"]
-        "created_at": str | None
       }
     """
     sb = get_client()
 
-    users_res = (
-        sb.schema("public")
-        .table("users")
-        .select("id,email,created_at")
+    # Roles come embedded per user (FK user_roles.user_id -> users.id): one query, no join in Python.
+    users = _fetch_all(
+        lambda: sb.table("users")
+        .select("id,email,user_roles(role)")
         .order("email")
-        .execute()
+        .order("id")
     )
-    users = users_res.data or []
-
-    roles_res = (
-        sb.schema("public")
-        .table("user_roles")
-        .select("user_id,role")
-        .execute()
-    )
-    roles_map = defaultdict(list)
-    for r in (roles_res.data or []):
-        roles_map[r["user_id"]].append(r["role"])
-
-    out: List[Dict[str, Any]] = []
-    for u in users:
-        out.append(
-            {
-                "id": u["id"],
-                "email": u.get("email") or "",
-                "display_name": None,  # placeholder; can later read from auth.users metadata
-                "roles": sorted(roles_map.get(u["id"], [])),
-                "created_at": u.get("created_at"),
-            }
-        )
-    return out
+    return [
+        {
+            "id": u["id"],
+            "email": u.get("email") or "",
+            "display_name": None,  # placeholder; can later read from auth.users metadata
+            "roles": sorted({r["role"] for r in (u.get("user_roles") or [])}),
+        }
+        for u in users
+    ]
 
 
 # ==========================
 # ==== Solicitador ======
 # ==========================
 
-@st.cache_data(ttl=30, show_spinner=False)
+@st.cache_data(ttl=30, max_entries=500, show_spinner=False)
 def list_my_expenses(user_id: str, status: Optional[str] = None) -> List[Dict[str, Any]]:
     sb = get_client()
     q = (
-        sb.schema("public")
-
-        .table("expenses")
+        sb.table("expenses")
         .select(
-            "id,amount,category,status,supporting_doc_key,created_at,"
+            "id,amount,category,status,supporting_doc_key,payment_doc_key,created_at,"
             "requested_by,description,reimbursement,reimbursement_person,suppliers(name)"
 
         )
@@ -203,7 +292,7 @@ def list_my_expenses(user_id: str, status: Optional[str] = None) -> List[Dict[st
         r["supplier_name"] = sup.get("name", "")
     return rows
 
-@st.cache_data(ttl=20, show_spinner=False)
+@st.cache_data(ttl=20, max_entries=200, show_spinner=False)
 def recent_similar_expenses(supplier_id: str, amount: float, days: int = 30) -> List[Dict[str, Any]]:
     """
     Very simple duplicate hint: same supplier AND same amount within N days.
@@ -212,11 +301,11 @@ def recent_similar_expenses(supplier_id: str, amount: float, days: int = 30) ->
     sb = get_client()
     since = (dt.datetime.utcnow() - dt.timedelta(days=days)).isoformat() + "Z"
     res = (
-        sb.schema("public")
-        .table("expenses")
-        .select("id,amount,category,status,supporting_doc_key,created_at")
+        sb.table("expenses")
+        .select("id,amount,status,supporting_doc_key,created_at")
         .eq("supplier_id", supplier_id)
-        .eq("amount", round(float(amount), 2))
+        # Literal decimal exacto: Postgres lo lee como numeric, sin pasar por float.
+        .eq("amount", f"{float(amount):.2f}")
         .gte("created_at", since)
         .order("created_at", desc=True)
         .limit(20)
@@ -224,20 +313,23 @@ def recent_similar_expenses(supplier_id: str, amount: float, days: int = 30) ->
     )
     return res.data or []
 
-def _emails_by_ids(ids: Iterable[str]) -> dict:
-    ids = [i for i in ids if i]
-    if not ids:
-        return {}
-    sb = get_client()
-    res = sb.schema("public").table("users").select("id,email").in_("id", ids).execute()
-    return {r["id"]: r.get("email") for r in (res.data or [])}
-
 def get_my_expense(user_id: str, expense_id: str) -> Optional[Dict[str, Any]]:
+    """Detalle de un gasto propio.
+
+    La lista de ``list_my_expenses`` ya trae las mismas columnas y suele estar
+    en caché cuando se abre el detalle; solo si no aparece ahí se consulta.
+    """
+    # Misma forma de llamada que solicitante.py: st.cache_data arma la clave
+    # con los argumentos tal como se pasan.
+    for row in list_my_expenses(user_id, status=None):
+        if row["id"] == expense_id:
+            return row
+    return _fetch_my_expense(user_id, expense_id)
+
+def _fetch_my_expense(user_id: str, expense_id: str) -> Optional[Dict[str, Any]]:
     sb = get_client()
     res = (
-        sb.schema("public")
-
-        .table("expenses")
+        sb.table("expenses")
         .select(
             "id,amount,category,status,supporting_doc_key,payment_doc_key,created_at,"
             "requested_by,description,reimbursement,reimbursement_person,suppliers(name)"
@@ -255,69 +347,87 @@ def get_my_expense(user_id: str, expense_id: str) -> Optional[Dict[str, Any]]:
     row["supplier_name"] = sup.get("name", "")
     return row
 
-def list_expense_logs(expense_id: str) -> List[Dict[str, Any]]:
-    """Lista los logs de una solicitud y agrega ``actor_email``."""
+@st.cache_data(ttl=20, max_entries=500, show_spinner=False)
+def get_expense_activity(expense_id: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Logs y comentarios de una solicitud, con ``actor_email``, en un solo paso.
+
+    Ambas tablas se leen en paralelo y los correos de todos los actores se
+    resuelven con una sola consulta a ``users``.
+    """
     sb = get_client()
-    res = (
-        sb.schema("public")
-        .table("expense_logs")
+    logs, comments = parallel_fetch(
+        lambda: sb.table("expense_logs")
         .select("actor_id,message,created_at")
         .eq("expense_id", expense_id)
         .order("created_at", desc=True)
         .execute()
-    )
-    rows = res.data or []
-    emails = _emails_by_ids({r["actor_id"] for r in rows})
-    for r in rows:
-        r["actor_email"] = emails.get(r["actor_id"])
-    return rows
-
-def list_expense_comments(expense_id: str) -> List[Dict[str, Any]]:
-    """Devuelve comentarios [{created_at, message, actor_email}, ...]"""
-    sb = get_client()
-    res = (
-        sb.schema("public")
-        .table("expense_comments")
+        .data
+        or [],
+        lambda: sb.table("expense_comments")
         .select("created_by,message,created_at")
         .eq("expense_id", expense_id)
         .order("created_at", desc=True)
         .execute()
+        .data
+        or [],
     )
-    rows = res.data or []
-    emails = _emails_by_ids({r["created_by"] for r in rows})
-    out = []
-    for r in rows:
-        out.append({
-            "created_at": r["created_at"],
-            "message": r.get("message", ""),
-            "actor_email": emails.get(r["created_by"]),
-        })
-    return out
+    emails = _emails_by_ids(
+        {r["actor_id"] for r in logs} | {r["created_by"] for r in comments}
+    )
+    for r in logs:
+        r["actor_email"] = emails.get(r["actor_id"])
+    return {
+        "logs": logs,
+        "comments": [
+            {
+                "created_at": r["created_at"],
+                "message": r.get("message", ""),
+                "actor_email": emails.get(r["created_by"]),
+            }
+            for r in comments
+        ],
+    }
+
+def list_expense_logs(expense_id: str) -> List[Dict[str, Any]]:
+    """Lista los logs de una solicitud (más recientes primero) y agrega ``actor_email``."""
+    return get_expense_activity(expense_id)["logs"]
+
+def list_expense_comments(expense_id: str) -> List[Dict[str, Any]]:
+    """Devuelve comentarios [{created_at, message, actor_email}, ...]"""
+    return get_expense_activity(expense_id)["comments"]
 
 ## APROBADOR
 
-def _emails_by_ids(ids: Iterable[str]) -> dict:
-    ids = [i for i in ids if i]
-    if not ids:
-        return {}
+@st.cache_data(ttl=60, show_spinner=False)
+def list_expense_status_counts(statuses: Iterable[str]) -> Dict[str, int]:
+    """
+    Conteo de expenses por estado sin traer filas: una consulta ``head`` con
+    ``count="exact"`` por estado, lanzadas en paralelo.
+    """
     sb = get_client()
-    res = sb.schema("public").table("users").select("id,email").in_("id", ids).execute()
-    return {r["id"]: r.get("email") for r in (res.data or [])}
+    statuses = list(statuses)
 
-# @st.cache_data(ttl=20, show_spinner=False)
+    def _count(status: str) -> Callable[[], int]:
+        return lambda: (
+            sb.table("expenses")
+            .select("id", count="exact", head=True)
+            .eq("status", status)
+            .execute()
+            .count
+            or 0
+        )
+
+    return dict(zip(statuses, parallel_fetch(*[_count(s) for s in statuses])))
+
+@st.cache_data(ttl=60, show_spinner=False)
 def list_expenses_for_status(status: Optional[str]) -> List[Dict[str, Any]]:
     """
     For Aprobador: all expenses (optionally filtered by status) with requester email.
     """
     sb = get_client()
     q = (
-        sb.schema("public")
-
-        .table("expenses")
-        .select(
-            "id,supplier_id,amount,category,description,status,created_at,"
-            "supporting_doc_key,payment_doc_key,requested_by,reimbursement,reimbursement_person,suppliers(name)"
-        )
+        sb.table("expenses")
+        .select("id,amount,category,description,status,created_at,requested_by,suppliers(name)")
         .order("created_at", desc=True)
     )
     if status:
@@ -332,12 +442,11 @@ def list_expenses_for_status(status: Optional[str]) -> List[Dict[str, Any]]:
         r["requested_by_email"] = emails.get(r["requested_by"], "")
     return rows
 
+@st.cache_data(ttl=60, max_entries=500, show_spinner=False)
 def get_expense_by_id_for_approver(expense_id: str) -> Optional[Dict[str, Any]]:
     sb = get_client()
     res = (
-        sb.schema("public")
-
-        .table("expenses")
+        sb.table("expenses")
         .select(
             "id,supplier_id,amount,category,description,status,created_at,"
             "supporting_doc_key,payment_doc_key,requested_by,reimbursement,reimbursement_person,suppliers(name)"
@@ -355,68 +464,94 @@ def get_expense_by_id_for_approver(expense_id: str) -> Optional[Dict[str, Any]]:
     row["requested_by_email"] = _emails_by_ids([row["requested_by"]]).get(row["requested_by"], "")
     return row
 
-@st.cache_data(ttl=30, show_spinner=False)
+# Se limpia en clear_expense_caches (nuevas solicitudes).
+@st.cache_resource(ttl=600, show_spinner=False)
 def list_requesters_for_approver() -> List[Dict[str, Any]]:
     """
     Distinct requesters with at least one expense.
     """
     sb = get_client()
-    res = sb.schema("public").table("expenses").select("requested_by").execute()
+    res = sb.table("expenses").select("requested_by").execute()
     ids = sorted({r["requested_by"] for r in (res.data or []) if r.get("requested_by")})
     emails = _emails_by_ids(ids)
     return [{"id": i, "email": emails.get(i, "")} for i in ids]
 
 # @st.cache_data(ttl=20, show_spinner=False)
-def list_expenses_by_supplier_id(supplier_id: str) -> List[Dict[str, Any]]:
+def _query_expenses_by_supplier_id(
+    supplier_id: str, limit: Optional[int] = None, offset: int = 0
+) -> List[Dict[str, Any]]:
+    """Como ``list_expenses_by_supplier_id`` pero deja pasar ``APIError``."""
     sb = get_client()
-    try:
-        res = (
-            sb.schema("public")
-            .table("expenses")
-            .select(
-                "id,amount,category,description,status,created_at,supporting_doc_key,requested_by,supplier_id"
-            )
-            .eq("supplier_id", supplier_id)
-            .order("created_at", desc=True)
-            .execute()
-        )
-    except APIError as e:
-        st.error("No se pudieron obtener los gastos para este proveedor.")
-        return []
-    base = res.data or []
-    # get name
-    sups = {
-        s["id"]: s["name"]
-        for s in (
-            get_client()
-            .schema("public")
-            .table("suppliers")
-            .select("id,name,category")
-            .execute()
-            .data
-            or []
+    q = (
+        sb.table("expenses")
+        .select(
+            "id,amount,category,description,status,created_at,supporting_doc_key,payment_doc_key,"
+            "requested_by,suppliers(name)"
         )
-    }
+        .eq("supplier_id", supplier_id)
+        .order("created_at", desc=True)
+    )
+    if limit:
+        q = q.range(offset, offset + limit - 1)
+    base = q.execute().data or []
     emails = _emails_by_ids({r["requested_by"] for r in base})
     for r in base:
-        r["supplier_name"] = sups.get(supplier_id, "")
+        sup = r.pop("suppliers", None) or {}
+        r["supplier_name"] = sup.get("name", "")
         r["requested_by_email"] = emails.get(r["requested_by"], "")
     return base
 
-@st.cache_data(ttl=20, show_spinner=False)
-def list_expenses_by_category(category: str) -> List[Dict[str, Any]]:
+
+def list_expenses_by_supplier_id(
+    supplier_id: str, limit: Optional[int] = None, offset: int = 0
+) -> List[Dict[str, Any]]:
+    try:
+        return _query_expenses_by_supplier_id(supplier_id, limit, offset)
+    except APIError as e:
+        st.error("No se pudieron obtener los gastos para este proveedor.")
+        return []
+
+
+@st.cache_data(ttl=60, max_entries=200, show_spinner=False)
+def get_approver_detail_bundle(expense_id: str) -> Optional[Dict[str, Any]]:
+    """Todo lo que muestra el detalle del aprobador para una solicitud.
+
+    Devuelve ``{"expense", "logs", "comments", "supplier_history"}`` o ``None``
+    si la solicitud no existe. Los errores de la API se propagan para que no
+    queden guardados en caché como un historial vacío.
+    """
+    exp = get_expense_by_id_for_approver(expense_id)
+    if not exp:
+        return None
+    sup_id = exp.get("supplier_id")
+    activity, history = parallel_fetch(
+        lambda: get_expense_activity(expense_id),
+        lambda: _query_expenses_by_supplier_id(sup_id) if sup_id else [],
+    )
+    return {
+        "expense": exp,
+        "logs": activity["logs"],
+        "comments": activity["comments"],
+        "supplier_history": history,
+    }
+
+@st.cache_data(ttl=20, max_entries=200, show_spinner=False)
+def list_expenses_by_category(
+    category: str, limit: Optional[int] = None, offset: int = 0
+) -> List[Dict[str, Any]]:
     sb = get_client()
-    res = (
-        sb.schema("public")
-        .table("expenses")
+    q = (
+        sb.table("expenses")
         .select(
             "id,amount,category,description,status,created_at,"
-            "supporting_doc_key,requested_by,reimbursement,reimbursement_person,suppliers(name)"
+            "supporting_doc_key,payment_doc_key,requested_by,suppliers(name)"
         )
         .eq("category", category)
         .order("created_at", desc=True)
-        .execute()
     )
+    if limit:
+        q = q.range(offset, offset + limit - 1)
+    res = q.execute()
     rows = res.data or []
     emails = _emails_by_ids({r["requested_by"] for r in rows})
     for r in rows:
@@ -425,20 +560,23 @@ def list_expenses_by_category(category: str) -> List[Dict[str, Any]]:
         r["requested_by_email"] = emails.get(r["requested_by"], "")
     return rows
 
-@st.cache_data(ttl=20, show_spinner=False)
-def list_expenses_by_requester(user_id: str) -> List[Dict[str, Any]]:
+@st.cache_data(ttl=20, max_entries=200, show_spinner=False)
+def list_expenses_by_requester(
+    user_id: str, limit: Optional[int] = None, offset: int = 0
+) -> List[Dict[str, Any]]:
     sb = get_client()
-    res = (
-        sb.schema("public")
-        .table("expenses")
+    q = (
+        sb.table("expenses")
         .select(
             "id,amount,category,description,status,created_at,"
-            "supporting_doc_key,requested_by,reimbursement,reimbursement_person,suppliers(name)"
+            "supporting_doc_key,payment_doc_key,requested_by,suppliers(name)"
         )
         .eq("requested_by", user_id)
         .order("created_at", desc=True)
-        .execute()
     )
+    if limit:
+        q = q.range(offset, offset + limit - 1)
+    res = q.execute()
     rows = res.data or []
     email = _emails_by_ids([user_id]).get(user_id, "")
     for r in rows:
@@ -446,6 +584,52 @@ def list_expenses_by_requester(user_id: str) -> List[Dict[str, Any]]:
         r["supplier_name"] = sup.get("name", "")
         r["requested_by_email"] = email
     return rows
+
+def clear_expense_caches() -> None:
+    """Invalida las lecturas cacheadas de expenses tras crear o cambiar uno."""
+    for fn in (
+        list_my_expenses,
+        list_expense_status_counts,
+        list_expenses_for_status,
+        get_expense_by_id_for_approver,
+        get_approver_detail_bundle,
+        get_expense_activity,
+        list_expenses_by_category,
+        list_expenses_by_requester,
+        list_paid_expenses_enriched,
+        list_requesters_for_approver,
+        list_approvers_for_viewer,
+    ):
+        fn.clear()
+
+
+def clear_expense_status_caches(expense_id: str, *statuses: str) -> None:
+    """Invalida solo lo afectado cuando ``expense_id`` cambia entre ``statuses``.
+
+    Las listas por estado de los demás estados siguen en caché.
+    """
+    for status in (*statuses, None):
+        list_expenses_for_status.clear(status)
+    get_expense_by_id_for_approver.clear(expense_id)
+    get_expense_activity.clear(expense_id)
+    for fn in (
+        list_my_expenses,
+        list_expense_status_counts,
+        get_approver_detail_bundle,
+        list_expenses_by_category,
+        list_expenses_by_requester,
+        list_paid_expenses_enriched,
+        list_approvers_for_viewer,
+    ):
+        fn.clear()
+
+
+def clear_expense_comment_caches(expense_id: str) -> None:
+    """Invalida la vista de detalle de ``expense_id`` tras agregar un comentario."""
+    get_expense_activity.clear(expense_id)
+    get_approver_detail_bundle.clear(expense_id)
+
+
 def receipt_file_key(key: str) -> Optional[str]:
     """Retorna la key almacenada para el documento de respaldo."""
     key = key or ""
@@ -458,14 +642,23 @@ def payment_file_key(key: str) -> Optional[str]:
     return key or None
 
 
+@functools.lru_cache(maxsize=4096)
+def _public_url(bucket: str, file_key: str) -> str:
+    """URL pública de ``file_key`` en ``bucket``.
+
+    Los buckets son públicos: la URL no expira y solo depende de
+    ``(bucket, key)``, así que se memoriza en el proceso sin TTL.
+    """
+    return get_client().storage.from_(bucket).get_public_url(file_key)
+
+
 def signed_url_for_receipt(key: str, expires: int = 600) -> Optional[str]:
     """Genera una URL pública para ``supporting_doc_key``."""
     file_key = receipt_file_key(key)
     if not file_key:
         return None
     try:
-        sb = get_client()
-        return sb.storage.from_("quotes").get_public_url(file_key)
+        return _public_url("quotes", file_key)
     except Exception:
         return None
 
@@ -476,8 +669,7 @@ def signed_url_for_payment(key: str, expires: int = 600) -> Optional[str]:
     if not file_key:
         return None
     try:
-        sb = get_client()
-        return sb.storage.from_("payments").get_public_url(file_key)
+        return _public_url("payments", file_key)
     except Exception:
         return None
 
@@ -493,8 +685,7 @@ def payment_doc_url_for_expense(
     sb = get_client()
     try:
         res = (
-            sb.schema("public")
-            .table("expenses")
+            sb.table("expenses")
             .select("payment_doc_key")
             .eq("id", expense_id)
             .single()
@@ -506,56 +697,26 @@ def payment_doc_url_for_expense(
     if not key:
         return None, None
     try:
-        url = sb.storage.from_("payments").get_public_url(key.strip())
+        url = _public_url("payments", key.strip())
         return url, key.strip()
     except Exception:
         return None, key.strip()
 
 
 
-def _emails_by_ids(ids: Iterable[str]) -> dict:
-    ids = [i for i in ids if i]
-    if not ids:
-        return {}
-    sb = get_client()
-    res = sb.schema("public").table("users").select("id,email").in_("id", ids).execute()
-    return {r["id"]: r.get("email") for r in (res.data or [])}
-
-@st.cache_data(ttl=60, show_spinner=False)
+# Se limpia al cambiar un estado (clear_expense_status_caches).
+@st.cache_resource(ttl=600, show_spinner=False)
 def list_approvers_for_viewer() -> List[Dict[str, Any]]:
     """
     Distinct approved_by with at least one expense (any status). Mapped to email.
     """
     sb = get_client()
-    res = sb.schema("public").table("expenses").select("approved_by").execute()
+    res = sb.table("expenses").select("approved_by").execute()
     ids = sorted({r["approved_by"] for r in (res.data or []) if r.get("approved_by")})
     emails = _emails_by_ids(ids)
     return [{"id": i, "email": emails.get(i, "")} for i in ids]
 
-@st.cache_data(ttl=30, show_spinner=False)
-def _paid_at_map_for_expenses(expense_ids: List[str]) -> Dict[str, str]:
-    """Devuelve expense_id -> paid_at usando ``expense_logs`` con mensaje de pago."""
-    if not expense_ids:
-        return {}
-    sb = get_client()
-    res = (
-        sb.schema("public")
-        .table("expense_logs")
-        .select("expense_id,created_at,message")
-        .in_("expense_id", expense_ids)
-        .ilike("message", "%solicitud pagada%")
-        .order("created_at", desc=True)
-        .execute()
-    )
-    rows = res.data or []
-    out = {}
-    for r in rows:
-        eid = r["expense_id"]
-        if eid not in out:
-            out[eid] = r["created_at"]  # primera (más reciente) por el order desc
-    return out
-
-@st.cache_data(ttl=30, show_spinner=False)
+@st.cache_data(ttl=30, max_entries=100, show_spinner=False)
 def list_paid_expenses_enriched(
     created_from: Optional[str] = None,
     created_to: Optional[str] = None,
@@ -565,33 +726,71 @@ def list_paid_expenses_enriched(
     approver_emails: Optional[set] = None,
     paid_from: Optional[str] = None,
     paid_to: Optional[str] = None,
-) -> List[Dict[str, Any]]:
+    limit: Optional[int] = None,
+) -> pd.DataFrame:
     """
-    Trae expenses pagados y enriquece con:
+    Trae expenses pagados como DataFrame (una fila por gasto) y enriquece con:
       - requested_by_email, approved_by_email, paid_by_email
-      - paid_at (desde expense_logs)
-    Aplica filtros de creación en SQL y filtros por nombre/categoría/email en Python.
-    También filtra por rango de paid_at en Python.
+      - paid_at (último log "Solicitud pagada", embebido en la misma consulta)
+    Aplica en SQL los filtros de creación, proveedor, categoría, solicitante
+    y aprobador (nombres y correos se traducen a ids con las listas en caché).
+    El rango de paid_at se filtra en Python.
+    Con ``limit`` trae solo los ``limit`` más recientes por creación;
+    ``df.attrs["has_more"]`` indica si quedaron filas sin traer. Con rango de
+    paid_at el ``limit`` se ignora: ese filtro corre después de la consulta y
+    cortar antes podría dejar fuera justo las filas del rango.
     """
+    if paid_from or paid_to:
+        limit = None
+
+    def _ids_matching(items: List[Dict[str, Any]], field: str, wanted: set) -> List[str]:
+        return [it["id"] for it in items if it.get(field) in wanted]
+
+    id_filters = {}
+    if supplier_names:
+        id_filters["supplier_id"] = _ids_matching(list_suppliers(), "name", supplier_names)
+    if requester_emails:
+        id_filters["requested_by"] = _ids_matching(
+            list_requesters_for_approver(), "email", requester_emails
+        )
+    if approver_emails:
+        id_filters["approved_by"] = _ids_matching(
+            list_approvers_for_viewer(), "email", approver_emails
+        )
+    if any(not ids for ids in id_filters.values()):
+        return pd.DataFrame()
+
     sb = get_client()
     q = (
-        sb.schema("public")
-        .table("expenses")
+        sb.table("expenses")
         .select(
-            "id,amount,category,description,status,created_at,"
+            "id,amount,category,description,created_at,"
             "supporting_doc_key,payment_doc_key,requested_by,approved_by,paid_by,"
-            "reimbursement,reimbursement_person,suppliers(name)"
+            "suppliers(name),expense_logs(created_at)"
         )
         .eq("status", "pagado")
         .order("created_at", desc=True)
+        # Solo el log de pago más reciente por gasto, resuelto en el servidor.
+        .ilike("expense_logs.message", "%solicitud pagada%")
+        .order("created_at", desc=True, foreign_table="expense_logs")
+        .limit(1, foreign_table="expense_logs")
     )
     if created_from:
         q = q.gte("created_at", created_from)
     if created_to:
         q = q.lte("created_at", created_to)
+    if categories:
+        q = q.in_("category", list(categories))
+    for column, ids in id_filters.items():
+        q = q.in_(column, ids)
+    if limit:
+        q = q.range(0, limit)  # una fila de más para saber si hay otra página
 
     res = q.execute()
     rows = res.data or []
+    has_more = bool(limit) and len(rows) > limit
+    if has_more:
+        rows = rows[:limit]
     for r in rows:
         sup = r.pop("suppliers", None) or {}
         r["supplier_name"] = sup.get("name", "")
@@ -607,37 +806,26 @@ def list_paid_expenses_enriched(
         r["approved_by_email"] = emails.get(r.get("approved_by"), "")
         r["paid_by_email"] = emails.get(r.get("paid_by"), "")
 
-    # paid_at desde logs
-    paid_map = _paid_at_map_for_expenses([r["id"] for r in rows])
+    # paid_at desde el log embebido
     for r in rows:
-        r["paid_at"] = paid_map.get(r["id"], r["created_at"])  # fallback: created_at
-
-    # Filtros por proveedor/categoría/solicitante/aprobador
-    def _keep(r):
-        if supplier_names and r["supplier_name"] not in supplier_names:
-            return False
-        if categories and r["category"] not in categories:
-            return False
-        if requester_emails and r.get("requested_by_email") not in requester_emails:
-            return False
-        if approver_emails and r.get("approved_by_email") not in approver_emails:
-            return False
-        return True
-
-    rows = [r for r in rows if _keep(r)]
+        logs = r.pop("expense_logs", None) or []
+        r["paid_at"] = logs[0]["created_at"] if logs else r["created_at"]  # fallback: created_at
 
     # Filtro por rango de paid_at (en Python)
-    if paid_from or paid_to:
-        def _in_paid_range(r):
-            ts = pd.to_datetime(r["paid_at"])
-            if paid_from and ts < pd.to_datetime(paid_from):
-                return False
-            if paid_to and ts > pd.to_datetime(paid_to):
-                return False
-            return True
-        rows = [r for r in rows if _in_paid_range(r)]
-
-    # Asegura tipos correctos para métricas
-    for r in rows:
-        r["amount"] = float(r["amount"])
-    return rows
+    if rows and (paid_from or paid_to):
+        paid = pd.to_datetime(
+            [r["paid_at"] for r in rows], errors="coerce", utc=True, format="ISO8601"
+        )
+        mask = pd.notna(paid)
+        if paid_from:
+            mask &= paid >= pd.Timestamp(paid_from)
+        if paid_to:
+            mask &= paid <= pd.Timestamp(paid_to)
+        rows = [r for r, keep in zip(rows, mask) if keep]
+
+    # Se arma una sola vez aquí para que la caché guarde el DataFrame listo.
+    df = pd.DataFrame.from_records(rows)
+    if not df.empty:
+        df["amount"] = df["amount"].astype("float64")  # tipos correctos para métricas
+    df.attrs["has_more"] = has_more
+    return df
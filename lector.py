@@ -15,6 +15,8 @@ from f_read import (
     signed_url_for_receipt,
     signed_url_for_payment,
     _render_download,
+    _fmt_dt,
+    parallel_fetch,
 )
 
 require_lector()
@@ -25,14 +27,8 @@ me = current_user()
 if not me:
     st.stop()
 
-# --------------------------
-# Utilidades locales
-# --------------------------
-def _fmt_dt(dt_str: str) -> str:
-    try:
-        return pd.to_datetime(dt_str).strftime("%Y-%m-%d %H:%M")
-    except Exception:
-        return dt_str
+LECTOR_PAGE_SIZE = 500
+st.session_state.setdefault("lector_limit", LECTOR_PAGE_SIZE)
 
 # --------------------------
 # Filtros globales
@@ -68,12 +64,14 @@ with col_dates:
             help="Filtra por fecha de marcado como pagado (logs)",
         )
 
-# Opciones de filtros por dimensión
-suppliers = list_suppliers()
+# Opciones de filtros por dimensión (lecturas independientes, en paralelo)
+suppliers, cats, reqs, aprs = parallel_fetch(
+    list_suppliers,
+    list_categories,
+    list_requesters_for_approver,            # [{id,email}]
+    list_approvers_for_viewer,               # [{id,email}]
+)
 supplier_names = [s["name"] for s in suppliers]
-cats = list_categories()
-reqs = list_requesters_for_approver()        # [{id,email}]
-aprs = list_approvers_for_viewer()           # [{id,email}]
 
 c3, c4, c5, c6 = st.columns(4)
 with c3:
@@ -96,10 +94,20 @@ def _range_to_iso(r):
 created_from, created_to = _range_to_iso(created_range)
 paid_from, paid_to = _range_to_iso(paid_range)
 
+# "Cargar más" vale solo para la combinación de filtros actual.
+filter_key = (
+    created_from, created_to, paid_from, paid_to,
+    tuple(sorted(sel_sups)), tuple(sorted(sel_cats)),
+    tuple(sorted(sel_reqs)), tuple(sorted(sel_aprs)),
+)
+if st.session_state.get("lector_filter_key") != filter_key:
+    st.session_state.lector_filter_key = filter_key
+    st.session_state.lector_limit = LECTOR_PAGE_SIZE
+
 # --------------------------
 # Carga datos (siempre pagados) + filtros
 # --------------------------
-rows = list_paid_expenses_enriched(
+df = list_paid_expenses_enriched(
     created_from=created_from,
     created_to=created_to,
     supplier_names=set(sel_sups) if sel_sups else None,
@@ -108,13 +116,24 @@ rows = list_paid_expenses_enriched(
     approver_emails=set(sel_aprs) if sel_aprs else None,
     paid_from=paid_from,
     paid_to=paid_to,
+    limit=st.session_state.lector_limit,
 )
 
-# DataFrame base
-df = pd.DataFrame(rows)
+def _load_more_control() -> None:
+    """Ofrece traer la siguiente tanda si la consulta quedó cortada."""
+    if not df.attrs.get("has_more"):
+        return
+    st.caption(f"Mostrando los {len(df)} gastos más recientes.")
+    if st.button("Cargar más", key="lector_load_more"):
+        st.session_state.lector_limit += LECTOR_PAGE_SIZE
+        st.rerun()
+
+# DataFrame base (ya armado y en caché)
 if df.empty:
     st.info("No hay gastos que coincidan con los filtros.")
+    _load_more_control()
     st.stop()
+df_by_id = df.set_index("id", drop=False)
 
 # --------------------------
 # Tabla y detalle de gastos
@@ -123,8 +142,8 @@ st.write("**Gastos filtrados**")
 
 # Tabla con columnas claves
 show_df = df.copy()
-show_df["Creado"] = show_df["created_at"].map(_fmt_dt)
-show_df["Pagado"] = show_df["paid_at"].map(_fmt_dt)
+show_df["Creado"] = _fmt_dt(show_df["created_at"])
+show_df["Pagado"] = _fmt_dt(show_df["paid_at"])
 show_df["Documento de respaldo"] = show_df["supporting_doc_key"].map(
     lambda k: signed_url_for_receipt(k.strip()) if isinstance(k, str) and k.strip() else None
 )
@@ -162,18 +181,24 @@ st.dataframe(
         ),
     },
 )
+_load_more_control()
 
 # Selector de un gasto
-opt_map = {
-    f"{r['supplier_name']} — {r.get('description','')} — {_fmt_dt(r['paid_at'])} — {r.get('requested_by_email','')}"
-    : r["id"]
-    for _, r in df.iterrows()
-}
+labels = df["supplier_name"].fillna("").astype(str).str.cat(
+    [
+        df["description"].fillna("").astype(str),
+        _fmt_dt(df["paid_at"]),
+        df["requested_by_email"].fillna("").astype(str),
+    ],
+    sep=" — ",
+)
+opt_map = dict(zip(labels, df["id"]))
 sel_label = st.selectbox("Selecciona un gasto para ver detalles", list(opt_map.keys()))
 eid = opt_map[sel_label]
 
 # Mostrar detalle con documentos y previsualización
-row = df[df["id"] == eid].iloc[0]
+row = df_by_id.loc[eid]
+creado, pagado = _fmt_dt([row["created_at"], row["paid_at"]])
 st.markdown(
     f"**Proveedor:** {row['supplier_name']}  \n"
     f"**Descripción:** {row.get('description','')}  \n"
@@ -182,8 +207,8 @@ st.markdown(
     f"**Solicitante:** {row.get('requested_by_email','')}  \n"
     f"**Aprobador:** {row.get('approved_by_email','')}  \n"
     f"**Pagador:** {row.get('paid_by_email','')}  \n"
-    f"**Creado:** {_fmt_dt(row['created_at'])}  \n"
-    f"**Pagado:** {_fmt_dt(row['paid_at'])}"
+    f"**Creado:** {creado}  \n"
+    f"**Pagado:** {pagado}"
 )
 
 st.divider()
@@ -2,6 +2,7 @@
 # Rol Pagador: métricas, listas por estado, detalles+marcar pagado, historial
 
 import mimetypes
+from collections import Counter
 import pandas as pd
 import streamlit as st
 import uuid
@@ -23,7 +24,13 @@ from f_read import (
     signed_url_for_receipt,
     signed_url_for_payment,
     payment_doc_url_for_expense,
+    clear_expense_status_caches,
+    clear_expense_comment_caches,
     _render_download,
+    _fmt_dt,
+    _records_df,
+    LOG_COLUMNS,
+    COMMENT_COLUMNS,
 )
 
 from f_cud import mark_expense_as_paid, add_expense_comment, update_expense_status
@@ -37,23 +44,33 @@ if not me:
     st.stop()
 user_id = me["id"]
 
-ESTADOS = ["solicitado", "aprobado", "rechazado", "pagado"]
+ESTADOS = ("solicitado", "aprobado", "rechazado", "pagado")
+ESTADOS_FILTRO = ("(todos)",) + ESTADOS
+_IDX_FILTRO = {s: i for i, s in enumerate(ESTADOS_FILTRO)}
+ESTADOS_DETALLE = ("aprobado", "pagado", "solicitado", "rechazado")
+ESTADOS_DETALLE_SET = frozenset(ESTADOS_DETALLE)
+ESTADOS_PAGADOR = ("aprobado", "pagado", "rechazado")
+_IDX_PAGADOR = {s: i for i, s in enumerate(ESTADOS_PAGADOR)}
 
 
-def _fmt_dt(s: str) -> str:
-    try:
-        return pd.to_datetime(s).strftime("%Y-%m-%d %H:%M")
-    except Exception:
-        return s
+def _expense_labels(rows) -> pd.Series:
+    """Textos consistentes para identificar gastos en selectores, armados en bloque."""
+    df = pd.DataFrame.from_records(
+        rows, columns=["supplier_name", "description", "created_at", "requested_by_email"]
+    )
+    return df["supplier_name"].fillna("").astype(str).str.cat(
+        [
+            df["description"].fillna("").astype(str),
+            _fmt_dt(df["created_at"]),
+            df["requested_by_email"].fillna("").astype(str),
+        ],
+        sep=" — ",
+    )
 
 
 def _expense_label(expense: dict) -> str:
-    """Texto consistente para identificar un gasto en selectores."""
-
-    return (
-        f"{expense['supplier_name']} — {expense.get('description','')} — "
-        f"{_fmt_dt(expense['created_at'])} — {expense.get('requested_by_email','')}"
-    )
+    """Texto de un solo gasto; mismo formato que ``_expense_labels``."""
+    return _expense_labels([expense]).iloc[0]
 
 
 def _copy_supporting_doc_to_payments(file_key: str) -> str:
@@ -92,24 +109,20 @@ def pagador_resumen_fragment():
     _ = st.session_state.get("pagador_resumen_refresh_token")
     all_rows = list_expenses_for_status(status=None) or []
 
-    counts = {e: 0 for e in ESTADOS}
-    for r in all_rows:
-        if r["status"] in counts:
-            counts[r["status"]] += 1
+    counts = Counter(r["status"] for r in all_rows)
     cols = st.columns(len(ESTADOS))
     for i, e in enumerate(ESTADOS):
-        cols[i].metric(e.capitalize(), counts[e])
+        cols[i].metric(e.capitalize(), counts.get(e, 0))
 
     st.divider()
 
-    estados_opts = ["(todos)"] + ESTADOS
     default_status = st.session_state.get("pagador_resumen_estado", "aprobado")
-    if default_status not in estados_opts:
-        default_status = estados_opts[0]
+    if default_status not in _IDX_FILTRO:
+        default_status = ESTADOS_FILTRO[0]
     selected_status = st.selectbox(
         "Filtrar por estado",
-        options=estados_opts,
-        index=estados_opts.index(default_status),
+        options=ESTADOS_FILTRO,
+        index=_IDX_FILTRO[default_status],
         key="pagador_resumen_estado",
     )
     rows = (
@@ -122,18 +135,16 @@ def pagador_resumen_fragment():
         st.caption("No hay solicitudes para este filtro.")
         return
 
-    df = pd.DataFrame(
-        [
-            {
-                "Solicitante": r.get("requested_by_email", ""),
-                "Monto": f"{r['amount']:.2f}",
-                "Descripción": r.get("description") or "",
-                "Categoría": r["category"],
-                "Proveedor": r["supplier_name"],
-                "Creado": _fmt_dt(r["created_at"]),
-            }
-            for r in rows
-        ]
+    df = _records_df(
+        rows,
+        {
+            "requested_by_email": "Solicitante",
+            "amount": "Monto",
+            "description": "Descripción",
+            "category": "Categoría",
+            "supplier_name": "Proveedor",
+            "created_at": "Creado",
+        },
     )
     st.dataframe(df, use_container_width=True, hide_index=True)
 
@@ -142,16 +153,15 @@ def pagador_resumen_fragment():
 def pagador_detalle_fragment():
     st.write("**Detalles y marcar pagado**")
 
-    estado_options = ["aprobado", "pagado", "solicitado", "rechazado"]
     override_key = "pagador_estado_sel_override"
     if override_key in st.session_state:
         override_value = st.session_state.pop(override_key)
-        if override_value in estado_options:
+        if override_value in ESTADOS_DETALLE_SET:
             st.session_state["pagador_estado_sel"] = override_value
-    st.session_state.setdefault("pagador_estado_sel", estado_options[0])
+    st.session_state.setdefault("pagador_estado_sel", ESTADOS_DETALLE[0])
     estado_sel = st.radio(
         "Elegir estado para seleccionar solicitudes:",
-        options=estado_options,
+        options=ESTADOS_DETALLE,
         horizontal=True,
         key="pagador_estado_sel",
     )
@@ -172,11 +182,10 @@ def pagador_detalle_fragment():
 
     labels = [""]
     label_to_id = {}
-    for r in rows:
-        label = _expense_label(r)
+    for label, rid in zip(_expense_labels(rows), (r["id"] for r in rows)):
         if label not in label_to_id:
             labels.append(label)
-            label_to_id[label] = r["id"]
+            label_to_id[label] = rid
 
     if len(labels) == 1:
         st.caption("No hay solicitudes en este estado.")
@@ -208,7 +217,7 @@ def pagador_detalle_fragment():
                         f"**Monto:** {exp['amount']:.2f}  \n"
                         f"**Categoría:** {exp['category']}  \n"
                         f"**Estado actual:** {exp['status']}  \n"
-                        f"**Creado:** {_fmt_dt(exp['created_at'])}  \n"
+                        f"**Creado:** {_fmt_dt([exp['created_at']])[0]}  \n"
                         f"**Solicitante:** {exp.get('requested_by_email','')}  \n"
                         f"**Reembolso:** {'Sí' if exp.get('reimbursement') else 'No'}"
                     )
@@ -236,16 +245,7 @@ def pagador_detalle_fragment():
                     st.write("**Historial (logs)**")
                     logs = list_expense_logs(expense_id)
                     if logs:
-                        log_df = pd.DataFrame(
-                            [
-                                {
-                                    "Fecha": _fmt_dt(l["created_at"]),
-                                    "Actor": l.get("actor_email", ""),
-                                    "Mensaje": l.get("message", ""),
-                                }
-                                for l in logs
-                            ]
-                        )
+                        log_df = _records_df(logs, LOG_COLUMNS)
                         st.dataframe(log_df, use_container_width=True, hide_index=True)
                     else:
                         st.caption("Sin historial.")
@@ -253,16 +253,7 @@ def pagador_detalle_fragment():
                     st.write("**Comentarios**")
                     comments = list_expense_comments(expense_id)
                     if comments:
-                        com_df = pd.DataFrame(
-                            [
-                                {
-                                    "Fecha": _fmt_dt(c["created_at"]),
-                                    "Autor": c.get("actor_email", ""),
-                                    "Comentario": c["message"],
-                                }
-                                for c in comments
-                            ]
-                        )
+                        com_df = _records_df(comments, COMMENT_COLUMNS)
                         st.dataframe(com_df, use_container_width=True, hide_index=True)
                     else:
                         st.caption("No hay comentarios.")
@@ -272,18 +263,16 @@ def pagador_detalle_fragment():
                     sup_id = exp.get("supplier_id")
                     hist_rows = list_expenses_by_supplier_id(sup_id) if sup_id else []
                     if hist_rows:
-                        hist_df = pd.DataFrame(
-                            [
-                                {
-                                    "Descripción": r.get("description", "") or "",
-                                    "Monto": f"{r['amount']:.2f}",
-                                    "Categoría": r["category"],
-                                    "Estado": r["status"],
-                                    "Solicitante": r.get("requested_by_email", ""),
-                                    "Creado": _fmt_dt(r["created_at"]),
-                                }
-                                for r in hist_rows
-                            ]
+                        hist_df = _records_df(
+                            hist_rows,
+                            {
+                                "description": "Descripción",
+                                "amount": "Monto",
+                                "category": "Categoría",
+                                "status": "Estado",
+                                "requested_by_email": "Solicitante",
+                                "created_at": "Creado",
+                            },
                         )
                         st.dataframe(hist_df, use_container_width=True, hide_index=True)
                     else:
@@ -292,15 +281,10 @@ def pagador_detalle_fragment():
                 with mid:
                     st.write("**Actualizar estado / marcar pagado**")
 
-                    estados_pagador = ["aprobado", "pagado", "rechazado"]
                     new_status = st.selectbox(
                         "Nuevo estado",
-                        options=estados_pagador,
-                        index=(
-                            estados_pagador.index(exp["status"])
-                            if exp["status"] in estados_pagador
-                            else 0
-                        ),
+                        options=ESTADOS_PAGADOR,
+                        index=_IDX_PAGADOR.get(exp["status"], 0),
                     )
 
                     existing_payment_date_raw = exp.get("payment_date")
@@ -435,6 +419,9 @@ def pagador_detalle_fragment():
                                         payment_date=payment_date_dt.strftime("%Y-%m-%d"),
                                         comment=comment_clean or None,
                                     )
+                                    clear_expense_status_caches(
+                                        expense_id, exp["status"], "pagado"
+                                    )
                                     msg = "Solicitud marcada como pagada."
                                     if not status_changed:
                                         msg = "Solicitud actualizada."
@@ -445,6 +432,7 @@ def pagador_detalle_fragment():
                                         st.session_state.pagador_historial_refresh_token += 1
                                 elif comment_clean:
                                     add_expense_comment(expense_id, user_id, comment_clean)
+                                    clear_expense_comment_caches(expense_id)
                                     st.success("Comentario agregado.")
                                     triggered_refresh = True
                                 else:
@@ -456,6 +444,7 @@ def pagador_detalle_fragment():
                                     )
                                 if comment_clean:
                                     add_expense_comment(expense_id, user_id, comment_clean)
+                                    clear_expense_comment_caches(expense_id)
                                     st.success("Comentario agregado.")
                                     triggered_refresh = True
                                 else:
@@ -553,28 +542,22 @@ def pagador_historial_fragment():
         st.caption("No hay gastos para este filtro.")
         return
 
-    df = pd.DataFrame(
-        [
-            {
-                "Proveedor": r["supplier_name"],
-                "Descripción": r.get("description", "") or "",
-                "Monto": f"{r['amount']:.2f}",
-                "Categoría": r["category"],
-                "Estado": r["status"],
-                "Solicitante": r.get("requested_by_email", ""),
-                "Creado": _fmt_dt(r["created_at"]),
-            }
-            for r in rows
-        ]
+    df = _records_df(
+        rows,
+        {
+            "supplier_name": "Proveedor",
+            "description": "Descripción",
+            "amount": "Monto",
+            "category": "Categoría",
+            "status": "Estado",
+            "requested_by_email": "Solicitante",
+            "created_at": "Creado",
+        },
     )
     st.dataframe(df, use_container_width=True, hide_index=True)
 
-    label_to_id = {}
-    labels = []
-    for r in rows:
-        label = _expense_label(r)
-        label_to_id[label] = r["id"]
-        labels.append(label)
+    labels = list(_expense_labels(rows))
+    label_to_id = dict(zip(labels, (r["id"] for r in rows)))
 
     if not labels:
         st.caption("No hay solicitudes para revisar.")
@@ -605,7 +588,7 @@ def pagador_historial_fragment():
         f"**Categoría:** {exp['category']}  \n"
         f"**Estado:** {exp['status']}  \n"
         f"**Solicitante:** {exp.get('requested_by_email','')}  \n"
-        f"**Creado:** {_fmt_dt(exp['created_at'])}"
+        f"**Creado:** {_fmt_dt([exp['created_at']])[0]}"
     )
     rec_key = exp.get("supporting_doc_key")
     pay_key = exp.get("payment_doc_key")
@@ -618,31 +601,13 @@ def pagador_historial_fragment():
     st.divider()
     logs = list_expense_logs(eid)
     if logs:
-        log_df = pd.DataFrame(
-            [
-                {
-                    "Fecha": _fmt_dt(l["created_at"]),
-                    "Actor": l.get("actor_email", ""),
-                    "Mensaje": l.get("message", ""),
-                }
-                for l in logs
-            ]
-        )
+        log_df = _records_df(logs, LOG_COLUMNS)
         st.write("**Historial (logs)**")
         st.dataframe(log_df, use_container_width=True, hide_index=True)
 
     comments = list_expense_comments(eid)
     if comments:
-        com_df = pd.DataFrame(
-            [
-                {
-                    "Fecha": _fmt_dt(c["created_at"]),
-                    "Autor": c.get("actor_email", ""),
-                    "Comentario": c["message"],
-                }
-                for c in comments
-            ]
-        )
+        com_df = _records_df(comments, COMMENT_COLUMNS)
         st.write("**Comentarios**")
         st.dataframe(com_df, use_container_width=True, hide_index=True)
     else:
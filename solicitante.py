@@ -18,6 +18,11 @@ from f_read import (
     list_expense_comments,
     list_expense_logs,
     list_people,
+    clear_expense_caches,
+    clear_expense_comment_caches,
+    _records_df,
+    LOG_COLUMNS,
+    COMMENT_COLUMNS,
 )
 from f_cud import create_expense, add_expense_comment
 
@@ -35,6 +40,7 @@ user_id = me["id"]
 
 tab_nueva, tab_mias, tab_detalle = st.tabs(["Nueva solicitud", "Mis solicitudes", "Detalles y actualizar"])
 
+
 if "solicitudes_metrics_dirty" not in st.session_state:
     st.session_state.solicitudes_metrics_dirty = True
 
@@ -198,11 +204,10 @@ def solicitud_nueva_fragment():
                     description=descripcion.strip() if descripcion else None,
                     reimbursement=reembolso,
                     reimbursement_person=reembolso_persona or None,
+                    comment=comentario_inicial,
                 )
 
-                if expense_id and (comentario_inicial or "").strip():
-                    add_expense_comment(expense_id, user_id, comentario_inicial.strip())
-
+                clear_expense_caches()
                 st.success("Solicitud creada correctamente.")
                 st.balloons()
                 st.session_state.reset_form = True
@@ -295,6 +300,7 @@ def solicitud_detalle_fragment():
             else:
                 try:
                     add_expense_comment(sel_id, user_id, txt.strip())
+                    clear_expense_comment_caches(sel_id)
                     st.success("Comentario agregado.")
                     st.session_state.solic_detalle_reset = True
                     st.session_state.solicitudes_metrics_dirty = True
@@ -303,27 +309,12 @@ def solicitud_detalle_fragment():
                 except Exception as e:
                     st.error(f"No se pudo guardar el comentario: {e}")
 
-    def _fmt_dt(s: str) -> str:
-        try:
-            return pd.to_datetime(s).strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            return s
-
     st.write("**Comentarios**")
     comentarios = list_expense_comments(sel_id)
     if not comentarios:
         st.caption("No hay comentarios.")
     else:
-        com_df = pd.DataFrame(
-            [
-                {
-                    "Fecha": _fmt_dt(c["created_at"]),
-                    "Autor": c.get("actor_email", ""),
-                    "Comentario": c["message"],
-                }
-                for c in comentarios
-            ]
-        )
+        com_df = _records_df(comentarios, COMMENT_COLUMNS)
         st.dataframe(com_df, use_container_width=True, hide_index=True)
 
     st.divider()
@@ -332,16 +323,7 @@ def solicitud_detalle_fragment():
     if not logs:
         st.caption("No hay historial.")
     else:
-        log_df = pd.DataFrame(
-            [
-                {
-                    "Fecha": _fmt_dt(lg["created_at"]),
-                    "Actor": lg.get("actor_email", ""),
-                    "Mensaje": lg.get("message", ""),
-                }
-                for lg in logs
-            ]
-        )
+        log_df = _records_df(logs, LOG_COLUMNS)
         st.dataframe(log_df, use_container_width=True, hide_index=True)
 
 